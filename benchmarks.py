@@ -0,0 +1,324 @@
+import argparse
+import contextlib
+import gc
+import io
+import itertools
+import json
+import math
+import random
+import sys
+import time
+import tracemalloc
+from functools import partial
+
+import numpy as np
+
+from evaluation import kl_divergence, mean_relative_error
+from locations_taxonomy import LocationsTaxonomy, TelAviv_json_dir
+from personalized_count_estimator import pce_runner, server_pce, basic_clusteting
+from planner import calibrate_cost_model, plan_pce
+from simulation import simulate_static_situation
+from utils import set_random_seed
+
+TAXONOMY_QUERIES_NUM = 10000
+REGRESSION_TOLERANCE = 0.2
+REPEATS = 3
+# the calls are timed in batches of at least MIN_BATCH_SECONDS (so the timer is not the noise of a sub-millisecond
+# call), and batches are run for at least MIN_MEASURE_SECONDS - the median batch of many is stable
+MIN_BATCH_SECONDS = 0.01
+MIN_MEASURE_SECONDS = 0.5
+PLANNER_RUNS = 8
+# the most times a regression is measured again before it is reported
+CONFIRM_RUNS = 2
+
+
+def synthetic_taxonomy_dict(branching, depth, name='Root'):
+    '''
+    :param branching: number of sub areas of every area
+    :param depth: number of levels under the root
+    :return: a full tree taxonomy dictionary, as in the json files
+    '''
+    if depth == 0:
+        return {'Name': name, 'sub_areas': []}
+    return {'Name': name, 'sub_areas': [synthetic_taxonomy_dict(branching, depth - 1, f'{name}_{i}')
+                                        for i in range(branching)]}
+
+
+def measure(function, *args, memory=True, repeats=REPEATS, min_seconds=MIN_MEASURE_SECONDS, **kwargs):
+    '''
+    the calls are batched as timeit.Timer.autorange does, so that every batch lasts at least MIN_BATCH_SECONDS, and
+    batches are run till they last min_seconds together (and at least repeats of them). the time of a call is the
+    median batch divided by its calls - on a shared machine the best batch is as noisy as a single call.
+    the random state after the measure is the one after the first run, so the next measures do not depend on the
+    number of calls
+    :param function: the function to measure
+    :param memory: also run it again under tracemalloc, for the peak memory
+    :param repeats: the least number of batches
+    :param min_seconds: the least time of all the batches together
+    :return: the result of the (first) run, its time in seconds, and the peak memory in bytes (None if not measured)
+    '''
+    with contextlib.redirect_stdout(io.StringIO()):
+        ts = time.perf_counter()
+        result = function(*args, **kwargs)
+        first_seconds = time.perf_counter() - ts
+        random_states = random.getstate(), np.random.get_state()
+        calls = max(1, math.ceil(MIN_BATCH_SECONDS / max(first_seconds, 1e-9)))
+        # a slow enough call is a batch of its own, and the first run is one
+        batches = [first_seconds] if calls == 1 else []
+        # as timeit - the garbage collector does not run inside the batches
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            while len(batches) < repeats or sum(batches) * calls < min_seconds:
+                ts = time.perf_counter()
+                for _ in range(calls):
+                    function(*args, **kwargs)
+                batches.append((time.perf_counter() - ts) / calls)
+        finally:
+            if gc_enabled:
+                gc.enable()
+        seconds = float(np.median(batches))
+        peak_memory = None
+        if memory:
+            tracemalloc.start()
+            function(*args, **kwargs)
+            _, peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        random.setstate(random_states[0])
+        np.random.set_state(random_states[1])
+    return result, seconds, peak_memory
+
+
+def _record(benchmark, seconds, peak_memory, items, **params):
+    return dict(benchmark=benchmark, seconds=seconds, peak_memory_bytes=peak_memory,
+                items_per_second=items / seconds if seconds > 0 else float('inf'), **params)
+
+
+def benchmark_taxonomy(taxonomy, taxonomy_name):
+    '''
+    :return: records of the throughput of the taxonomy queries
+    '''
+    records = []
+    for height in sorted(taxonomy.nodes_by_height.keys()):
+        _, seconds, _ = measure(lambda: [taxonomy.get_random_node(height) for _ in range(TAXONOMY_QUERIES_NUM)],
+                                memory=False)
+        records.append(_record('taxonomy.get_random_node', seconds, None, TAXONOMY_QUERIES_NUM,
+                               taxonomy=taxonomy_name, height=height))
+    nodes = [taxonomy.get_random_node() for _ in range(TAXONOMY_QUERIES_NUM)]
+    _, seconds, _ = measure(lambda: [taxonomy.get_leaves_enumerated(node) for node in nodes], memory=False)
+    records.append(_record('taxonomy.get_leaves_enumerated', seconds, None, TAXONOMY_QUERIES_NUM,
+                           taxonomy=taxonomy_name))
+    _, seconds, _ = measure(lambda: [taxonomy.get_number_leaves(node) for node in nodes], memory=False)
+    records.append(_record('taxonomy.get_number_leaves', seconds, None, TAXONOMY_QUERIES_NUM, taxonomy=taxonomy_name))
+    return records
+
+
+def benchmark_configuration(taxonomy, taxonomy_name, num_users, height, beta, epsilons, memory=True):
+    '''
+    :return: records of the simulation, the server and the metrics on a single configuration
+    '''
+    params = dict(taxonomy=taxonomy_name, num_users=num_users, height=height, beta=beta)
+    records = []
+    (inputs_dictionary, users), seconds, peak_memory = measure(
+        simulate_static_situation, taxonomy=taxonomy, epsilons=epsilons, num_users=num_users, height=height,
+        beta=beta, memory=memory)
+    records.append(_record('simulate_static_situation', seconds, peak_memory, num_users, **params))
+
+    largest_cluster = max(basic_clusteting(users).values(), key=len)
+    _, seconds, peak_memory = measure(server_pce, beta, largest_cluster, taxonomy, memory=memory)
+    records.append(_record('server_pce', seconds, peak_memory, len(largest_cluster), **params))
+
+    results_dictionary, seconds, peak_memory = measure(pce_runner, users, memory=memory, **inputs_dictionary)
+    records.append(_record('pce_runner', seconds, peak_memory, num_users,
+                           mean_relative_error=float(results_dictionary['mean_relative_error_value']), **params))
+
+    estimated_counts = results_dictionary['estimated_counts_list']
+    real_counts = results_dictionary['real_counts_list']
+    _, seconds, _ = measure(mean_relative_error, estimated_counts, real_counts, sanity_bound=1, memory=False)
+    records.append(_record('mean_relative_error', seconds, None, len(real_counts), **params))
+    _, seconds, _ = measure(kl_divergence, estimated_counts, real_counts, memory=False)
+    records.append(_record('kl_divergence', seconds, None, len(real_counts), **params))
+    return records
+
+
+def benchmark_planner(taxonomy, taxonomy_name, num_users, height, beta, epsilons, cost_model=None, runs=PLANNER_RUNS,
+                      **plan_params):
+    '''
+    checks the predictions of the planner against measured runs of its plan, and against the closed form m
+    :param runs: number of seeds the MRE is measured over - it is noisy
+    :param plan_params: target_mean_relative_error, memory_budget, latency_budget, merge_below (see plan_pce)
+    :return: a record of the predicted and the measured seconds and MRE
+    '''
+    params = dict(taxonomy=taxonomy_name, num_users=num_users, height=height, beta=beta)
+    inputs_dictionary, users = simulate_static_situation(taxonomy=taxonomy, epsilons=epsilons, num_users=num_users,
+                                                         height=height, beta=beta)
+    clusters_sizes = {tau_index: len(tau_users) for tau_index, tau_users in basic_clusteting(users).items()}
+    plan, plan_seconds, _ = measure(plan_pce, taxonomy, clusters_sizes, beta, epsilons, cost_model=cost_model,
+                                    memory=False, repeats=1, **plan_params)
+    measured = {}
+    for name, run_plan in (('plan', plan), ('closed_form', None)):
+        seconds, errors = float('inf'), []
+        for random_seed in range(runs):
+            results_dictionary, run_seconds, _ = measure(pce_runner, users, plan=run_plan, random_seed=random_seed,
+                                                         memory=False, repeats=1, **inputs_dictionary)
+            seconds = min(seconds, run_seconds)
+            errors.append(float(results_dictionary['mean_relative_error_value']))
+        measured[name] = seconds, sum(errors) / runs
+    record = _record('planner', measured['plan'][0], None, num_users, mean_relative_error=measured['plan'][1],
+                     predicted_seconds=plan.predicted_seconds,
+                     predicted_mean_relative_error=plan.predicted_mean_relative_error,
+                     closed_form_seconds=measured['closed_form'][0],
+                     closed_form_mean_relative_error=measured['closed_form'][1], planning_seconds=plan_seconds,
+                     **params)
+    record.update({key: value for key, value in plan.summary().items() if key not in record})
+    return record
+
+
+def _record_key(record):
+    return tuple((key, record[key]) for key in ('benchmark', 'taxonomy', 'num_users', 'height', 'beta')
+                 if key in record)
+
+
+def _regressions(record, base, tolerance):
+    regressions = []
+    if record['items_per_second'] < base['items_per_second'] * (1 - tolerance):
+        regressions.append(f"{dict(_record_key(record))}: throughput {record['items_per_second']:.1f} "
+                           f"vs. {base['items_per_second']:.1f}")
+    if record.get('peak_memory_bytes') and base.get('peak_memory_bytes') and \
+            record['peak_memory_bytes'] > base['peak_memory_bytes'] * (1 + tolerance):
+        regressions.append(f"{dict(_record_key(record))}: peak memory {record['peak_memory_bytes']} "
+                           f"vs. {base['peak_memory_bytes']}")
+    if 'mean_relative_error' in record and 'mean_relative_error' in base and \
+            record['mean_relative_error'] > base['mean_relative_error'] * (1 + tolerance):
+        regressions.append(f"{dict(_record_key(record))}: mean relative error "
+                           f"{record['mean_relative_error']:.4f} vs. {base['mean_relative_error']:.4f}")
+    return regressions
+
+
+def _best_record(record, other):
+    # the best measures of two records of the same benchmark
+    best = dict(record)
+    if other['items_per_second'] > record['items_per_second']:
+        best.update(seconds=other['seconds'], items_per_second=other['items_per_second'])
+    if other.get('peak_memory_bytes') and record.get('peak_memory_bytes'):
+        best['peak_memory_bytes'] = min(record['peak_memory_bytes'], other['peak_memory_bytes'])
+    return best
+
+
+def compare_to_baseline(records, baseline_records, tolerance=REGRESSION_TOLERANCE, remeasure=None,
+                        confirm_runs=CONFIRM_RUNS):
+    '''
+    :param records: the records of this run
+    :param baseline_records: the records of a saved run
+    :param tolerance: the relative slowdown (or growth in memory / error) that is still not a regression
+    :param remeasure: a function that measures the given records again (see remeasure_records) - a regression is
+    only kept if the best of all the measures still has it, as a busy machine can slow down any single measure
+    :param confirm_runs: the most times the regressed records are measured again
+    :return: a description of every regression found
+    '''
+    baseline = {_record_key(record): record for record in baseline_records}
+    records = {_record_key(record): record for record in records}
+    for run in range(confirm_runs + 1):
+        regressed = [record for key, record in records.items()
+                     if key in baseline and _regressions(record, baseline[key], tolerance)]
+        if not regressed or remeasure is None or run == confirm_runs:
+            break
+        for record in remeasure(regressed):
+            if _record_key(record) in records:
+                records[_record_key(record)] = _best_record(records[_record_key(record)], record)
+    return [regression for record in regressed
+            for regression in _regressions(record, baseline[_record_key(record)], tolerance)]
+
+
+def remeasure_records(taxonomy, taxonomy_name, records, epsilons, memory=True, random_seed=0):
+    '''
+    :param records: records of benchmark_taxonomy and benchmark_configuration
+    :return: new records of the same benchmarks - the taxonomy ones, and all the ones of the configurations
+    '''
+    new_records = []
+    if any(record['benchmark'].startswith('taxonomy.') for record in records):
+        new_records.extend(benchmark_taxonomy(taxonomy, taxonomy_name))
+    for num_users, height, beta in sorted({(record['num_users'], record['height'], record['beta'])
+                                           for record in records if 'num_users' in record}):
+        set_random_seed(random_seed)
+        new_records.extend(benchmark_configuration(taxonomy, taxonomy_name, num_users, height, beta, epsilons,
+                                                   memory=memory))
+    return new_records
+
+
+def run_benchmarks(taxonomy, taxonomy_name, users_nums, heights, betas, epsilons, memory=True, random_seed=0,
+                   planner=None):
+    '''
+    :param planner: the params of plan_pce (and cost_model) to check the planner with, instead of the benchmarks
+    '''
+    records = [] if planner is not None else benchmark_taxonomy(taxonomy, taxonomy_name)
+    for num_users, height, beta in itertools.product(users_nums, heights, betas):
+        if height not in taxonomy.nodes_by_height:
+            continue
+        set_random_seed(random_seed)
+        if planner is not None:
+            records.append(benchmark_planner(taxonomy, taxonomy_name, num_users, height, beta, epsilons, **planner))
+        else:
+            records.extend(benchmark_configuration(taxonomy, taxonomy_name, num_users, height, beta, epsilons,
+                                                   memory=memory))
+    return records
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmarks of the estimator, the simulator and the taxonomy')
+    parser.add_argument('--users', type=int, nargs='+', default=[1000, 10000, 100000, 1000000])
+    parser.add_argument('--heights', type=int, nargs='+', default=[1, 2, 3])
+    parser.add_argument('--betas', type=float, nargs='+', default=[0.1])
+    parser.add_argument('--epsilons', type=float, nargs='+', default=[0.25, 0.5, 0.75])
+    parser.add_argument('--taxonomy', default=TelAviv_json_dir, help='the json of the taxonomy to run on')
+    parser.add_argument('--synthetic', type=int, nargs=2, metavar=('BRANCHING', 'DEPTH'),
+                        help='run on a synthetic full tree taxonomy instead of the json')
+    parser.add_argument('--no-memory', action='store_true', help='skip the (slower) peak memory measurement')
+    parser.add_argument('--output', help='a json file to write the records to (stdout if not given)')
+    parser.add_argument('--baseline', help='a json file of saved records to compare to')
+    parser.add_argument('--tolerance', type=float, default=REGRESSION_TOLERANCE)
+    parser.add_argument('--planner', action='store_true',
+                        help='check the predictions of the planner against measured runs, instead of the benchmarks')
+    parser.add_argument('--target-mre', type=float, help='the target MRE of the planner')
+    parser.add_argument('--memory-budget', type=int, help='the bytes of phi the planner may use')
+    parser.add_argument('--latency-budget', type=float, help='the seconds the planner may use')
+    parser.add_argument('--merge-below', type=int, help='the planner merges clusters with less users')
+    parser.add_argument('--calibrate', action='store_true', help='measure the cost model of the planner first')
+    args = parser.parse_args(argv)
+
+    if args.synthetic:
+        branching, depth = args.synthetic
+        taxonomy = LocationsTaxonomy(json_dict=synthetic_taxonomy_dict(branching, depth))
+        taxonomy_name = f'synthetic_{branching}_{depth}'
+    else:
+        taxonomy = LocationsTaxonomy(args.taxonomy)
+        taxonomy_name = args.taxonomy
+
+    planner = None
+    if args.planner:
+        planner = dict(target_mean_relative_error=args.target_mre, memory_budget=args.memory_budget,
+                       latency_budget=args.latency_budget, merge_below=args.merge_below,
+                       cost_model=calibrate_cost_model(taxonomy) if args.calibrate else None)
+    records = run_benchmarks(taxonomy, taxonomy_name, args.users, args.heights, args.betas, args.epsilons,
+                             memory=not args.no_memory, planner=planner)
+    output = json.dumps(records, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline_records = json.load(f)
+        remeasure = None if args.planner else \
+            partial(remeasure_records, taxonomy, taxonomy_name, epsilons=args.epsilons, memory=not args.no_memory)
+        regressions = compare_to_baseline(records, baseline_records, tolerance=args.tolerance, remeasure=remeasure)
+        for regression in regressions:
+            print(f'regression - {regression}', file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
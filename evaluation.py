@@ -1,4 +1,4 @@
-import math
+from statistics import NormalDist
 from typing import List
 
 import numpy as np
@@ -8,12 +8,29 @@ from utils import ESTIMATED_COUNTS_LIST, REAL_COUNTS_LIST
 SMALL_NUMBER = 0.01
 
 
-def _normalize(q):
-    return np.array(q) / np.linalg.norm(q)
+def _normalize(q, axis=-1):
+    q = np.asarray(q, dtype=float)
+    return q / np.linalg.norm(q, axis=axis, keepdims=True)
 
 
 def _positivize(q):
-    return np.maximum(np.array(q), SMALL_NUMBER)
+    return np.maximum(np.asarray(q, dtype=float), SMALL_NUMBER)
+
+
+def kl_divergence_array(estimated_counts, real_counts, axis=-1):
+    '''
+    KL-divergence of the estimated vs. real counts, over arrays - a run per row of a 2-D array
+    :param estimated_counts: the estimated counts by our method, the leaves along axis
+    :param real_counts: the real counts, of the same shape (or broadcastable to it)
+    :param axis: the axis of the leaves
+    :return: the KL-divergence of every run
+    '''
+    estimated_counts = _normalize(_positivize(estimated_counts), axis=axis)
+    assert (np.asarray(real_counts) >= 0).all()
+    real_counts = _normalize(_positivize(real_counts), axis=axis)
+    inside_kl = estimated_counts * np.log(estimated_counts / real_counts)
+    where_kl = np.where(estimated_counts != 0, inside_kl, 0)
+    return np.sum(where_kl, axis=axis)
 
 
 def kl_divergence(estimated_counts, real_counts):
@@ -23,12 +40,29 @@ def kl_divergence(estimated_counts, real_counts):
     :param real_counts: a list of the real conts of the method
     :return:
     '''
-    estimated_counts = _normalize(_positivize(estimated_counts))
-    assert (np.array(real_counts) >= 0).all()
-    real_counts = _normalize(_positivize(real_counts))
-    inside_kl = estimated_counts * np.log(estimated_counts / real_counts)
-    where_kl = np.where(estimated_counts != 0, inside_kl, 0)
-    return np.sum(where_kl)
+    return kl_divergence_array(estimated_counts, real_counts)
+
+
+def relative_errors(estimated_counts, real_counts, sanity_bound):
+    '''
+    the relative error of every leaf, as in mean_relative_error - over arrays of any (broadcastable) shape
+    '''
+    estimated_counts = np.abs(np.asarray(estimated_counts, dtype=float))
+    real_counts = np.abs(np.asarray(real_counts, dtype=float))
+    return np.abs(estimated_counts - real_counts) / np.maximum(estimated_counts, sanity_bound)
+
+
+def mean_relative_error_array(estimated_counts, real_counts, sanity_bound, axis=-1):
+    '''
+    the MRE over arrays - a run per row of a 2-D array
+    :param estimated_counts: the estimated counts by our method, the leaves along axis
+    :param real_counts: the real counts, of the same shape (or broadcastable to it)
+    :param sanity_bound:
+    :param axis: the axis of the leaves
+    :return: the MRE of every run, and the relative error of every leaf
+    '''
+    errors = relative_errors(estimated_counts, real_counts, sanity_bound)
+    return np.mean(errors, axis=axis), errors
 
 
 def mean_relative_error(estimated_counts: List[int], real_counts: List[int], sanity_bound: int):
@@ -40,25 +74,88 @@ def mean_relative_error(estimated_counts: List[int], real_counts: List[int], san
     :return:
     '''
     assert len(estimated_counts) == len(real_counts)
-    changes_list = [math.fabs(math.fabs(real) - math.fabs(estimated)) / max(math.fabs(real), sanity_bound) for real, estimated in
-                    zip(estimated_counts, real_counts)]
-    return np.mean(changes_list), changes_list
+    return mean_relative_error_array(estimated_counts, real_counts, sanity_bound)
+
+
+def l1_error(estimated_counts, real_counts, axis=-1):
+    # the total absolute error of every run
+    return np.sum(np.abs(np.asarray(estimated_counts, dtype=float) - real_counts), axis=axis)
+
+
+def linf_error(estimated_counts, real_counts, axis=-1):
+    # the worst absolute error of every run
+    return np.max(np.abs(np.asarray(estimated_counts, dtype=float) - real_counts), axis=axis)
+
+
+def mean_relative_error_per_height(estimated_counts, real_counts, heights, sanity_bound=1):
+    '''
+    the MRE of the nodes of every height separately - for counts of all the nodes of the taxonomy
+    :param estimated_counts: estimated counts per node, the nodes along the last axis
+    :param real_counts: the real counts per node
+    :param heights: the height of every node (as taxonomy.heights)
+    :param sanity_bound:
+    :return: the heights, and the MRE per height - of shape (..., number of heights)
+    '''
+    heights = np.asarray(heights)
+    errors = relative_errors(estimated_counts, real_counts, sanity_bound)
+    unique_heights, height_ids = np.unique(heights, return_inverse=True)
+    one_hot = np.zeros((len(heights), len(unique_heights)))
+    one_hot[np.arange(len(heights)), height_ids] = 1
+    return unique_heights, (errors @ one_hot) / one_hot.sum(axis=0)
+
+
+def evaluate_runs(estimated_counts, real_counts, sanity_bound=1):
+    '''
+    all the metrics at once, for many runs of the same leaves (as all the seeds of a configuration)
+    :param estimated_counts: a run per row - (runs, leaves), or a single run (leaves,)
+    :param real_counts: the real counts - (runs, leaves), or (leaves,) shared by all the runs
+    :param sanity_bound:
+    :return: a dictionary of an array per metric, a value for every run
+    '''
+    mean_relative_error_value, _ = mean_relative_error_array(estimated_counts, real_counts, sanity_bound)
+    return {'kl_divergence_value': kl_divergence_array(estimated_counts, real_counts),
+            'mean_relative_error_value': mean_relative_error_value,
+            'l1_error': l1_error(estimated_counts, real_counts),
+            'linf_error': linf_error(estimated_counts, real_counts)}
+
+
+def summarize_runs(metrics, confidence=0.95):
+    '''
+    the distribution of every metric over the runs
+    :param metrics: a dictionary of an array per metric, a value for every run (as evaluate_runs)
+    :param confidence: the confidence level of the intervals
+    :return: for every metric - its values, their mean and std, the confidence interval of the mean (normal
+    approximation) and the central interval the values of a single run fall in, at that confidence
+    '''
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    summary = {}
+    for name, values in metrics.items():
+        values = np.asarray(values, dtype=float)
+        mean, std = float(np.mean(values)), float(np.std(values, ddof=1)) if len(values) > 1 else 0.0
+        half_width = z * std / np.sqrt(len(values))
+        summary.update({name: values, f'{name}_mean': mean, f'{name}_std': std,
+                        f'{name}_ci_low': mean - half_width, f'{name}_ci_high': mean + half_width,
+                        f'{name}_interval_low': float(np.quantile(values, (1 - confidence) / 2)),
+                        f'{name}_interval_high': float(np.quantile(values, (1 + confidence) / 2))})
+    return summary
 
 
 def evaluate_results_dictionary(real_counts, estimated_private_counts, sanity_bound=1):
     '''
     print and return evaluation of the estimated and real counts
-    :param real_counts:
-    :param estimated_private_counts:
+    :param real_counts: a dictionary of the counts per leaf, or an array of them
+    :param estimated_private_counts: a dictionary with the same keys, or an array aligned with real_counts
     :param sanity_bound:
     :return:
     '''
-    assert real_counts.keys() == estimated_private_counts.keys()
-    real_counts_list = []
-    estimated_counts_list = []
-    for key, value in real_counts.items():
-        real_counts_list.append(value)
-        estimated_counts_list.append(estimated_private_counts[key])
+    if isinstance(real_counts, dict):
+        assert real_counts.keys() == estimated_private_counts.keys()
+        real_counts_list = np.array(list(real_counts.values()))
+        estimated_counts_list = np.array([estimated_private_counts[key] for key in real_counts.keys()])
+    else:
+        real_counts_list = np.asarray(real_counts)
+        estimated_counts_list = np.asarray(estimated_private_counts)
+        assert real_counts_list.shape == estimated_counts_list.shape
 
     kl_divergence_value = kl_divergence(estimated_counts_list, real_counts_list)
     print('----------------------------')
@@ -1,46 +1,76 @@
-import copy
 import itertools
+import json
 import multiprocessing
+import os
 import time
-import numpy as np
+from functools import partial
 
-import pandas as pd
+import numpy as np
 
 import tqdm
 
-from evaluation import mean_relative_error
-from personalized_count_estimator import pce_runner
-from simulation import simulate_static_situation, change_static_simulation, make_dynamic_effects_dictionary
-from utils import ESTIMATED_COUNTS_LIST, REAL_COUNTS_LIST, CHANGES, set_random_seed, timing
+from evaluation import evaluate_runs, mean_relative_error, mean_relative_error_array, summarize_runs
+from locations_taxonomy import TelAviv_json_dir, load_taxonomy
+from personalized_count_estimator import DynamicPCE, estimate_clusters, pce_runner
+from simulation import simulate_static_situation, change_static_simulation, make_dynamic_effects_dictionary, \
+    simulate_static_changes
+from profiling import is_enabled, profiled, registry
+from results_store import ResultsStore, export_excel, summarize
+from utils import ESTIMATED_COUNTS_LIST, REAL_COUNTS_LIST, CHANGES, set_random_seed
 
 
-def static_situation_investigate():
+def static_situation_investigate(results_directory='results/static_situation', excel=False):
     '''
     A one-core static evaluation of different - run this function for Experiment #1
-    :return: save a file to the appropriate folder of the results of the experiment - for all the different params
+    :param results_directory: the results of every run are appended to a store (see ResultsStore) in it
+    :param excel: also export the scalar results as an excel file
+    :return: the scalar results of the experiment - for all the different params
     '''
-    results_dictionaries = []
-    for epsilons in [[0.25, 0.5, 0.75], [0.75, 1.0, 1.25]]:
-        for num_users in [1000, 10000, 100000]:
-            for height in [1, 2, 3]:
-                inputs_dictionary, users = simulate_static_situation(epsilons=epsilons, num_users=num_users,
-                                                                     height=height)
-                results_dictionary = pce_runner(users, **inputs_dictionary)
-                results_dictionary.update(inputs_dictionary)
-                results_dictionaries.append(results_dictionary)
-    df = pd.DataFrame(results_dictionaries)
-    df = df.drop('taxonomy', axis=1)
     timestr = time.strftime("%Y%m%d-%H%M%S")
-    df.to_excel(f"results/static_situation/{timestr}.xlsx")
+    store_directory = os.path.join(results_directory, timestr)
+    with ResultsStore(store_directory) as store:
+        for epsilons in [[0.25, 0.5, 0.75], [0.75, 1.0, 1.25]]:
+            for num_users in [1000, 10000, 100000]:
+                for height in [1, 2, 3]:
+                    inputs_dictionary, users = simulate_static_situation(epsilons=epsilons, num_users=num_users,
+                                                                         height=height)
+                    results_dictionary = pce_runner(users, **inputs_dictionary)
+                    results_dictionary.update(inputs_dictionary)
+                    store.append(results_dictionary)
+    df = store.load_scalars()
+    if excel:
+        export_excel(df, os.path.join(results_directory, f'{timestr}.xlsx'))
+    return df
+
+
+_worker_taxonomy = None
+
+
+def _init_worker(taxonomy_json_file):
+    # loads the taxonomy once per worker process, instead of sending it with every task
+    global _worker_taxonomy
+    _worker_taxonomy = load_taxonomy(taxonomy_json_file)
+
+
+def _get_worker_taxonomy():
+    if _worker_taxonomy is None:
+        _init_worker(TelAviv_json_dir)
+    return _worker_taxonomy
+
+
+def _task_key(task, incremental=False, monte_carlo_runs=None):
+    # a stable identification of a configuration of the experiment - for skipping the finished ones
+    mode = (['incremental'] if incremental else []) + ([f'monte_carlo_{monte_carlo_runs}'] if monte_carlo_runs else [])
+    return json.dumps(list(task) + mode)
 
 
-def get_chunks(iterable, chunks=1):
-    # This is from http://stackoverflow.com/a/2136090/2073595
-    lst = list(iterable)
-    return [lst[i::chunks] for i in range(chunks)]
+def _task_cost(task):
+    # an estimate of the work of a configuration - the users of both pce runs
+    epsilons, num_users, height, deletion_probability, addition_probability, random_seed = task
+    return num_users * (2 - deletion_probability + addition_probability)
 
 
-def dynamic_experiment_worker(pairs):
+def dynamic_experiment_worker(task, incremental=False):
     '''
     helper function for running the dynamic experiment  (Experiment #2)
     This function actually outputs the results of Experiment #1 too.
@@ -50,15 +80,27 @@ def dynamic_experiment_worker(pairs):
     adds/delete users form the list
     check the ability of the server-pce on it, again
 
-    :param pairs:
-    :return: results dictionaries for the duull dynamic experiment
+    :param task: the params of a single configuration
+    :param incremental: estimate the change by applying only the deleted and added users to the accumulators of the
+    first estimation (see DynamicPCE), instead of estimating the changed users from scratch
+    :return: results dictionary for the full dynamic experiment - the scalar results and the arrays of the leaves
     '''
-    results_dictionaries = []
-
-    for epsilons, num_users, height, deletion_probability, addition_probability, random_seed in pairs:
-        set_random_seed(random_seed)
-        inputs_dictionary, users = simulate_static_situation(epsilons=epsilons, num_users=num_users,
-                                                             height=height)
+    epsilons, num_users, height, deletion_probability, addition_probability, random_seed = task
+    set_random_seed(random_seed)
+    inputs_dictionary, users = simulate_static_situation(taxonomy=_get_worker_taxonomy(), epsilons=epsilons,
+                                                         num_users=num_users, height=height)
+    if incremental:
+        dynamic_pce = DynamicPCE(users, inputs_dictionary['taxonomy'], inputs_dictionary['beta'])
+        original_results_dictionary = dynamic_pce.evaluate()
+        inputs_dictionary_change, stayed, more_users = simulate_static_changes(users, deletion_probability,
+                                                                               addition_probability,
+                                                                               inputs_dictionary)
+        real_change, estimated_change, covered_leaves = dynamic_pce.apply_changes(np.flatnonzero(~stayed),
+                                                                                  more_users)
+        # as make_dynamic_effects_dictionary - the original counts minus the changed ones
+        dynamic_effects_dictionary = {CHANGES + REAL_COUNTS_LIST: -real_change[covered_leaves],
+                                      CHANGES + ESTIMATED_COUNTS_LIST: -estimated_change[covered_leaves]}
+    else:
         original_results_dictionary = pce_runner(users, **inputs_dictionary)
         inputs_dictionary_change, changed_users = change_static_simulation(users, deletion_probability,
                                                                            addition_probability,
@@ -68,50 +110,128 @@ def dynamic_experiment_worker(pairs):
         dynamic_effects_dictionary = make_dynamic_effects_dictionary(original_results_dictionary,
                                                                      changed_results_dictionary)
 
-        mean_relative_dynamic_change, changes_list = mean_relative_error(
-            dynamic_effects_dictionary[CHANGES + ESTIMATED_COUNTS_LIST],
-            dynamic_effects_dictionary[CHANGES + REAL_COUNTS_LIST],
-            sanity_bound=0.0001)
-
-        original_results_dictionary['changes_list'] = changes_list
-        original_results_dictionary['random_seed'] = random_seed
-        original_results_dictionary.update(dynamic_effects_dictionary)
-        original_results_dictionary.update(inputs_dictionary)
-        original_results_dictionary['mean_relative_dynamic_change'] = mean_relative_dynamic_change
-        original_results_dictionary['deletion_probability'] = deletion_probability
-        original_results_dictionary['addition_probability'] = addition_probability
-        results_dictionaries.append(original_results_dictionary)
-
-    return results_dictionaries
-
-
-@timing
-def dynamic_situation_investigate():
+    mean_relative_dynamic_change, changes_list = mean_relative_error(
+        dynamic_effects_dictionary[CHANGES + ESTIMATED_COUNTS_LIST],
+        dynamic_effects_dictionary[CHANGES + REAL_COUNTS_LIST],
+        sanity_bound=0.0001)
+
+    original_results_dictionary['changes_list'] = changes_list
+    original_results_dictionary['random_seed'] = random_seed
+    original_results_dictionary.update(dynamic_effects_dictionary)
+    original_results_dictionary.update(inputs_dictionary)
+    original_results_dictionary['mean_relative_dynamic_change'] = mean_relative_dynamic_change
+    original_results_dictionary['deletion_probability'] = deletion_probability
+    original_results_dictionary['addition_probability'] = addition_probability
+    original_results_dictionary['incremental'] = incremental
+    original_results_dictionary['task_key'] = _task_key(task, incremental)
+    # the taxonomy is not sent back to the parent process
+    return {key: value for key, value in original_results_dictionary.items() if key != 'taxonomy'}
+
+
+def dynamic_monte_carlo_worker(task, runs):
+    '''
+    the dynamic experiment of a configuration as a monte carlo - the population and its changes are simulated once,
+    and both estimations are run runs times at once (see pce_monte_carlo), instead of a task per seed
+    :param task: the params of a single configuration
+    :param runs: number of randomizations of the estimations
+    :return: results dictionary - every metric in every run, with its mean, std and intervals over the runs
+    '''
+    epsilons, num_users, height, deletion_probability, addition_probability, random_seed = task
+    set_random_seed(random_seed)
+    inputs_dictionary, users = simulate_static_situation(taxonomy=_get_worker_taxonomy(), epsilons=epsilons,
+                                                         num_users=num_users, height=height)
+    _, changed_users = change_static_simulation(users, deletion_probability, addition_probability, inputs_dictionary)
+    taxonomy, beta = inputs_dictionary['taxonomy'], inputs_dictionary['beta']
+    _, real_counts, estimated_counts, covered_leaves = estimate_clusters(users, taxonomy, beta, runs=runs)
+    _, changed_real_counts, changed_estimated_counts, changed_covered_leaves = estimate_clusters(
+        changed_users, taxonomy, beta, runs=runs)
+
+    metrics = evaluate_runs(estimated_counts[:, covered_leaves], real_counts[covered_leaves])
+    changed_leaves = covered_leaves | changed_covered_leaves
+    metrics['mean_relative_dynamic_change'], _ = mean_relative_error_array(
+        (estimated_counts - changed_estimated_counts)[:, changed_leaves],
+        (real_counts - changed_real_counts)[changed_leaves], sanity_bound=0.0001)
+
+    results_dictionary = summarize_runs(metrics)
+    results_dictionary.update(inputs_dictionary)
+    results_dictionary.update(random_seed=random_seed, runs=runs, deletion_probability=deletion_probability,
+                              addition_probability=addition_probability,
+                              task_key=_task_key(task, monte_carlo_runs=runs))
+    return {key: value for key, value in results_dictionary.items() if key != 'taxonomy'}
+
+
+def _instrumented_worker(task, incremental=False, monte_carlo_runs=None):
+    # the results row, and the spans the worker recorded for it - to be merged in the parent process
+    if monte_carlo_runs:
+        return dynamic_monte_carlo_worker(task, monte_carlo_runs), registry.snapshot()
+    return dynamic_experiment_worker(task, incremental=incremental), registry.snapshot()
+
+
+def dynamic_situation_investigate(results_directory='results/dynamic_situation', taxonomy_json_file=TelAviv_json_dir,
+                                  incremental=False, monte_carlo_runs=None, excel=False):
     '''
     This function actually runs the dynamic experiment with the hyperparameters I reported in the handout.
-    :return:
+    every finished configuration is appended to the store of the results (see ResultsStore), and re-running skips
+    the ones already there.
+    :param results_directory: the store is in its 'store' directory, the summaries are written next to it
+    :param taxonomy_json_file: the taxonomy every worker process loads once
+    :param incremental: estimate the changes incrementally (see dynamic_experiment_worker)
+    :param monte_carlo_runs: a single population per configuration, with this number of randomizations of its
+    estimations run at once (see dynamic_monte_carlo_worker) - instead of the seeds. it estimates both populations
+    from scratch, so it can not be incremental
+    :param excel: also export the summary as an excel file
+    :return: the summary of the experiment
     '''
+    if incremental and monte_carlo_runs:
+        raise ValueError('the monte carlo runs estimate both populations from scratch - they can not be incremental')
+    timestr = time.strftime("%Y%m%d-%H%M%S")
+    df = _dynamic_situation_investigate(timestr, results_directory, taxonomy_json_file, incremental=incremental,
+                                        monte_carlo_runs=monte_carlo_runs, excel=excel)
+    if is_enabled():
+        # after the profiled run returned - so its own span is in the dump too
+        registry.to_json(os.path.join(results_directory, f'{timestr}_spans.json'))
+    return df
+
+
+@profiled
+def _dynamic_situation_investigate(timestr, results_directory, taxonomy_json_file, incremental, monte_carlo_runs,
+                                   excel):
+    # the run of dynamic_situation_investigate, as a span of its own
     epsilons_lists = [[0.25, 0.5, 0.75]] #[[0.75, 1.0, 1.25]]  # ,
     num_users_lists = [10000, 50000, 100000, 300000]
     heights_lists = [1, 2, 3]
     deletion_probability_list = [0.01, 0.5]
     addition_probability_list = [0.01, 0.5]
-    random_seed = list(range(5))
-    products = itertools.product(epsilons_lists, num_users_lists, heights_lists, deletion_probability_list,
-                                 addition_probability_list, random_seed)
-    products_copy = copy.deepcopy(products)
-    print(f'number of products is: {len(list(products_copy))}')
-    chunked_pairs = get_chunks(products, chunks=multiprocessing.cpu_count())
-    with multiprocessing.Pool(multiprocessing.cpu_count()) as p:
-        results_dictionaries_list_lists = tqdm.tqdm(p.map(dynamic_experiment_worker, chunked_pairs))
-    results_dictionaries_lists = [item for sublist in results_dictionaries_list_lists for item in sublist]
-    df = pd.DataFrame(results_dictionaries_lists)
-    df = df.groupby(by=['num_users', 'height', 'beta', 'deletion_probability', 'addition_probability']).agg(
-        {'mean_relative_dynamic_change': [np.mean, np.std], 'kl_divergence_value': [np.mean, np.std],
-         'mean_relative_error_value': [np.mean, np.std]})
-    df = df.sort_values(by=('mean_relative_dynamic_change', 'mean'))
-    timestr = time.strftime("%Y%m%d-%H%M%S")
-    df.to_excel(f"results/dynamic_situation/{timestr}_{epsilons_lists}.xlsx")
+    random_seed = [0] if monte_carlo_runs else list(range(5))
+    products = list(itertools.product(epsilons_lists, num_users_lists, heights_lists, deletion_probability_list,
+                                      addition_probability_list, random_seed))
+    print(f'number of products is: {len(products)}')
+    # a shard per row - every finished configuration is on the disk at once, so a killed sweep loses none of them
+    store = ResultsStore(os.path.join(results_directory, 'store'), shard_size=1)
+    finished_keys = set(store.load_scalars(['task_key'])['task_key'])
+    products_keys = {_task_key(task, incremental, monte_carlo_runs) for task in products}
+    # the heaviest first - one at a time, so no core waits for a chunk of heavy tasks of another core
+    tasks = sorted([task for task in products if _task_key(task, incremental, monte_carlo_runs) not in finished_keys],
+                   key=_task_cost, reverse=True)
+    print(f'{len(products) - len(tasks)} already finished in {store.directory}')
+    worker = partial(_instrumented_worker, incremental=incremental, monte_carlo_runs=monte_carlo_runs)
+    with multiprocessing.Pool(multiprocessing.cpu_count(), initializer=_init_worker,
+                              initargs=(taxonomy_json_file,)) as p, store:
+        for results_dictionary, spans in tqdm.tqdm(p.imap_unordered(worker, tasks), total=len(tasks)):
+            registry.merge(spans)
+            store.append(results_dictionary)
+    # only the rows of this mode of the experiment - the store may have the others too
+    df = store.load_scalars()
+    df = df[df['task_key'].isin(products_keys)]
+    if monte_carlo_runs:
+        df = df.sort_values(by='mean_relative_dynamic_change_mean')
+    else:
+        df = summarize(df, by=['num_users', 'height', 'beta', 'deletion_probability', 'addition_probability'],
+                       metrics=['mean_relative_dynamic_change', 'kl_divergence_value', 'mean_relative_error_value'],
+                       sort_by=('mean_relative_dynamic_change', 'mean'))
+    if excel:
+        export_excel(df, os.path.join(results_directory, f'{timestr}_{epsilons_lists}.xlsx'))
+    return df
 
 
 if __name__ == '__main__':
@@ -1,8 +1,14 @@
+import hashlib
+import os
 import random
+from functools import lru_cache
 
-from anytree import Node, LevelOrderIter, PreOrderIter
+import numpy as np
+from anytree import Node
 import json
 
+from utils import get_generator
+
 TelAviv_json_dir = 'tel_aviv.json'
 
 
@@ -13,53 +19,310 @@ class Location:
         self.node = Node(name, parent=parent)
 
 
+class TaxonomyNode:
+    '''
+    a node of a LocationsTaxonomy as a view of its arrays - made in O(1) when it is asked for, unlike the anytree
+    nodes (see LocationsTaxonomy.nodes). it has the attributes of the anytree nodes the queries used.
+    '''
+    __slots__ = ('taxonomy', 'index')
+
+    def __init__(self, taxonomy, index):
+        self.taxonomy = taxonomy
+        self.index = int(index)
+
+    @property
+    def name(self):
+        return str(self.taxonomy.names[self.index])
+
+    @property
+    def parent(self):
+        parent = int(self.taxonomy.parents[self.index])
+        return None if parent < 0 else TaxonomyNode(self.taxonomy, parent)
+
+    @property
+    def depth(self):
+        return int(self.taxonomy.depths[self.index])
+
+    @property
+    def height(self):
+        return int(self.taxonomy.heights[self.index])
+
+    @property
+    def is_leaf(self):
+        return bool(self.taxonomy.is_leaf[self.index])
+
+    @property
+    def is_root(self):
+        return self.index == 0
+
+    @property
+    def path(self):
+        # the nodes from the root to this node - O(depth)
+        indices = [self.index]
+        while self.taxonomy.parents[indices[-1]] >= 0:
+            indices.append(int(self.taxonomy.parents[indices[-1]]))
+        return tuple(TaxonomyNode(self.taxonomy, index) for index in reversed(indices))
+
+    def __eq__(self, other):
+        return isinstance(other, TaxonomyNode) and other.taxonomy is self.taxonomy and other.index == self.index
+
+    def __hash__(self):
+        return hash(self.index)
+
+    def __repr__(self):
+        return f'TaxonomyNode(index={self.index}, name={self.name!r})'
+
+
 def build_sub_tree(dictionary, parent=None, count_till_now=0):
-    node = Node(dictionary['Name'], parent, index=count_till_now)
-    count_till_now += 1
-    # print(count_till_now)
-    for sub_dict in dictionary['sub_areas']:
-        count_till_now, _ = build_sub_tree(sub_dict, node, count_till_now)
-    return count_till_now, node
+    '''
+    builds the anytree nodes of the taxonomy dictionary, indexed in pre-order - iteratively, so deep trees are fine
+    :return: the index after the last node, and the root node of the sub tree
+    '''
+    root_node = None
+    stack = [(dictionary, parent)]
+    while stack:
+        sub_dict, sub_parent = stack.pop()
+        node = Node(sub_dict['Name'], sub_parent, index=count_till_now)
+        if root_node is None:
+            root_node = node
+        count_till_now += 1
+        stack.extend((child_dict, node) for child_dict in reversed(sub_dict['sub_areas']))
+    return count_till_now, root_node
+
+
+def flatten_taxonomy_dict(dictionary):
+    '''
+    the taxonomy dictionary as arrays, in pre-order - iteratively, without building any node
+    :return: the names, the parents and the depths of the nodes
+    '''
+    names, parents, depths = [], [], []
+    stack = [(dictionary, -1, 0)]
+    while stack:
+        sub_dict, parent, depth = stack.pop()
+        index = len(names)
+        names.append(sub_dict['Name'])
+        parents.append(parent)
+        depths.append(depth)
+        stack.extend((child_dict, index, depth + 1) for child_dict in reversed(sub_dict['sub_areas']))
+    return np.array(names), np.array(parents, dtype=np.int64), np.array(depths, dtype=np.int64)
 
 
 class LocationsTaxonomy:
-    def __init__(self, json_file):
-        with open(json_file, 'r') as f:
-            self.json_dict = json.load(f)
-        self.max_index, self.root_node = build_sub_tree(self.json_dict)
-        # for pre, fill, node in RenderTree(self.root_node):
-        #     print("%s%s" % (pre, node.name))
-        leaves_nodes = [node for node in LevelOrderIter(self.root_node) if len(node.children) == 0]
-        self.leaves_enumeration = {node.index: i for (i, node) in enumerate(leaves_nodes)}
+    '''
+    the taxonomy of the locations. all the queries are answered from flat arrays indexed by the pre-order index of
+    the nodes, and the nodes they return are TaxonomyNode views of the arrays - the anytree nodes of the whole tree
+    are built only if nodes (or root_node) is used.
+    '''
+    COMPILED_ARRAYS = ('names', 'parents', 'depths', 'heights', 'leaves_start', 'leaves_end')
+
+    def __init__(self, json_file=None, json_dict=None):
+        '''
+        :param json_file: the json of the taxonomy
+        :param json_dict: the taxonomy as an already loaded dictionary, instead of json_file
+        '''
+        if json_dict is None:
+            with open(json_file, 'r') as f:
+                json_dict = json.load(f)
+        self.json_dict = json_dict
+        self.names, self.parents, self.depths = flatten_taxonomy_dict(self.json_dict)
+        # a stable identification of the taxonomy by its content - the same in every process
+        content = hashlib.sha256(self.parents.tobytes())
+        content.update('\0'.join(self.names.tolist()).encode())
+        self.content_hash = content.hexdigest()
+        self._build_flat_index()
+        self._build_derived_index()
+
+    def _build_flat_index(self):
+        '''
+        builds once the arrays all the queries are answered from - all indexed by the pre-order index of the node:
+        heights, and the range [leaves_start, leaves_end) of the ids of the leaves under each node
+        (the pre-order numbering makes the leaves of every subtree contiguous).
+        '''
+        nodes_num = len(self.parents)
+        is_leaf = np.bincount(self.parents[1:], minlength=nodes_num) == 0
+        self.leaves_start = np.cumsum(is_leaf) - is_leaf
+        self.leaves_end = self.leaves_start + is_leaf
+        self.heights = np.zeros(nodes_num, dtype=np.int64)
+        # bottom up - level by level, every node takes the max over its children
+        nodes_by_depth = np.argsort(self.depths, kind='stable')
+        depth_ends = np.cumsum(np.bincount(self.depths))
+        for depth in range(len(depth_ends) - 1, 0, -1):
+            children = nodes_by_depth[depth_ends[depth - 1]:depth_ends[depth]]
+            np.maximum.at(self.heights, self.parents[children], self.heights[children] + 1)
+            np.maximum.at(self.leaves_end, self.parents[children], self.leaves_end[children])
+
+    def _build_derived_index(self):
+        self.max_index = len(self.parents)
+        self.is_leaf = self.heights == 0
+        self.leaves_node_indices = np.flatnonzero(self.is_leaf)
+        nodes_by_height = np.argsort(self.heights, kind='stable')
+        height_ends = np.cumsum(np.bincount(self.heights))
+        self.nodes_by_height = {height: nodes_by_height[height_ends[height] - count:height_ends[height]]
+                                for height, count in enumerate(np.bincount(self.heights)) if count > 0}
+        self._nodes = None
+        self._leaves_enumeration = None
+
+    def save(self, directory):
+        '''
+        saves the compiled taxonomy - an .npy file per array, so it can be loaded memory mapped
+        :param directory: the directory to save into
+        '''
+        os.makedirs(directory, exist_ok=True)
+        for name in self.COMPILED_ARRAYS:
+            np.save(os.path.join(directory, f'{name}.npy'), getattr(self, name))
+        with open(os.path.join(directory, 'taxonomy.json'), 'w') as f:
+            json.dump({'content_hash': self.content_hash}, f)
+
+    @staticmethod
+    def load(directory, mmap=True):
+        '''
+        loads a compiled taxonomy (see save) - memory mapped, the processes that load it share its pages
+        :param directory: the directory it was saved into
+        :param mmap: memory map the arrays instead of reading them
+        :return: the taxonomy
+        '''
+        taxonomy = LocationsTaxonomy.__new__(LocationsTaxonomy)
+        for name in LocationsTaxonomy.COMPILED_ARRAYS:
+            setattr(taxonomy, name, np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r' if mmap else None))
+        with open(os.path.join(directory, 'taxonomy.json'), 'r') as f:
+            taxonomy.content_hash = json.load(f)['content_hash']
+        taxonomy.json_dict = None
+        taxonomy._build_derived_index()
+        return taxonomy
+
+    @property
+    def nodes(self):
+        # the anytree nodes of the whole tree, in pre-order - built on the first use, in O(nodes * depth) (anytree checks
+        # the ancestors of every new node), so none of the queries use them
+        if self._nodes is None:
+            nodes = []
+            for index, (name, parent) in enumerate(zip(self.names.tolist(), self.parents.tolist())):
+                nodes.append(Node(name, nodes[parent] if parent >= 0 else None, index=index))
+            self._nodes = nodes
+        return self._nodes
+
+    @property
+    def root_node(self):
+        return self.nodes[0]
+
+    @property
+    def leaves_enumeration(self):
+        if self._leaves_enumeration is None:
+            self._leaves_enumeration = {int(index): i for (i, index) in enumerate(self.leaves_node_indices)}
+        return self._leaves_enumeration
+
+    @staticmethod
+    def _as_index(node):
+        if isinstance(node, (int, np.integer)):
+            return int(node)
+        return node.index
 
     def get_random_node(self, height=-1):
-        height_nodes = [node for node in LevelOrderIter(self.root_node) if (height == -1 or height == node.height)]
+        height_nodes = range(self.max_index) if height == -1 else self.nodes_by_height.get(height, [])
         if len(height_nodes) == 0:
             print('not enough nodes in this height')
             return None
-        return random.choice(height_nodes)
+        return self.get_node(random.choice(height_nodes))
+
+    def get_node(self, index):
+        return TaxonomyNode(self, index)
 
     def get_paths_from_root(self):
-        return [list(leaf.path) for leaf in PreOrderIter(self.root_node, filter_=lambda node: node.is_leaf)]
+        # the ancestors of all the leaves are found together, a level at a time
+        levels = [self.leaves_node_indices]
+        while (levels[-1] > 0).any():
+            levels.append(np.where(levels[-1] > 0, self.parents[np.maximum(levels[-1], 0)], -1))
+        paths = np.stack(levels[::-1], axis=1).tolist()
+        return [[TaxonomyNode(self, index) for index in path if index >= 0] for path in paths]
+
+    def get_leaves_range(self, root_node):
+        '''
+        :param root_node: a node, or its index
+        :return: the range [start, end) of the ids of the leaves under the node
+        '''
+        index = self._as_index(root_node)
+        return int(self.leaves_start[index]), int(self.leaves_end[index])
+
+    def get_leaves_node_indices(self, root_node):
+        start, end = self.get_leaves_range(root_node)
+        return self.leaves_node_indices[start:end]
+
+    def get_leaf_ids(self, leaves_indices):
+        # the id of a leaf among all the leaves is the start of its own range
+        return self.leaves_start[leaves_indices]
 
     def get_leaves_enumerated(self, root_node: Node):
-        leaves_nodes = self.get_leaves(root_node)
-        return [(node.index, node) for node in leaves_nodes]
+        return [(int(index), self.get_node(index)) for index in self.get_leaves_node_indices(root_node)]
 
     def get_random_leaf(self, root_node: Node):
-        leaves_nodes = self.get_leaves_enumerated(root_node)
-        index, rand_node = random.choice(leaves_nodes)
-        return index, rand_node
+        start, end = self.get_leaves_range(root_node)
+        index = int(self.leaves_node_indices[random.randrange(start, end)])
+        return index, self.get_node(index)
 
-    @staticmethod
-    def get_leaves(root_node: Node):
-        leaves_nodes = [node for node in LevelOrderIter(root_node) if len(node.children) == 0]
-        return leaves_nodes
+    def sample_random_nodes(self, height, size, rng=None):
+        '''
+        :param height: the height of the nodes to sample from, -1 for all the nodes
+        :param size: number of nodes to sample
+        :param rng: numpy Generator, drawn from the global seed if None
+        :return: indices of uniformly random nodes in this height
+        '''
+        rng = get_generator(rng)
+        height_nodes = np.arange(self.max_index) if height == -1 else self.nodes_by_height.get(height, [])
+        assert len(height_nodes) > 0, 'not enough nodes in this height'
+        return height_nodes[rng.integers(len(height_nodes), size=size)]
+
+    def sample_random_leaves(self, root_indices, rng=None):
+        '''
+        :param root_indices: indices of nodes
+        :param rng: numpy Generator, drawn from the global seed if None
+        :return: for each node - the index of a uniformly random leaf under it
+        '''
+        rng = get_generator(rng)
+        starts = self.leaves_start[root_indices]
+        ends = self.leaves_end[root_indices]
+        leaf_ids = starts + (rng.random(len(starts)) * (ends - starts)).astype(np.int64)
+        return self.leaves_node_indices[leaf_ids]
+
+    def aggregate_leaf_counts(self, leaf_counts):
+        '''
+        the counts of all the nodes, as the sums over their leaves ranges - so every parent is the sum of its children
+        :param leaf_counts: counts per leaf id, the leaves along the last axis (a run per row is fine)
+        :return: counts per node index, the nodes along the last axis
+        '''
+        leaf_counts = np.asarray(leaf_counts)
+        cumulative_counts = np.concatenate([np.zeros(leaf_counts.shape[:-1] + (1,), dtype=leaf_counts.dtype),
+                                            np.cumsum(leaf_counts, axis=-1)], axis=-1)
+        return cumulative_counts[..., self.leaves_end] - cumulative_counts[..., self.leaves_start]
+
+    def get_leaves_under_height(self, height):
+        '''
+        :param height: a height of nodes in the taxonomy
+        :return: the ids of all the leaves that are under a node of this height, and the index of that node for each
+        (the nodes of the same height are disjoint subtrees, so there is only one)
+        '''
+        height_nodes = self.nodes_by_height.get(height, np.array([], dtype=np.int64))
+        starts = self.leaves_start[height_nodes]
+        sizes = self.leaves_end[height_nodes] - starts
+        offsets = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        return np.repeat(starts, sizes) + offsets, np.repeat(height_nodes, sizes)
+
+    def get_leaves(self, root_node: Node):
+        return [self.get_node(index) for index in self.get_leaves_node_indices(root_node)]
+
+    def get_number_leaves(self, root_node: Node):
+        start, end = self.get_leaves_range(root_node)
+        return end - start
+
+@lru_cache(maxsize=None)
+def load_taxonomy(json_file=TelAviv_json_dir):
+    '''
+    :param json_file: the json of the taxonomy, or the directory of a compiled one (see LocationsTaxonomy.save)
+    :return: the taxonomy, loaded only once per process
+    '''
+    if os.path.isdir(json_file):
+        return LocationsTaxonomy.load(json_file)
+    return LocationsTaxonomy(json_file)
 
-    @staticmethod
-    def get_number_leaves(root_node: Node):
-        leaves_nodes = LocationsTaxonomy.get_leaves(root_node)
-        return len(leaves_nodes)
 
 if __name__ == "__main__":
     random.seed(1)
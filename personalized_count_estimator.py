@@ -1,77 +1,511 @@
 import math
-import random
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 
-from evaluation import evaluate_results_dictionary
+from evaluation import evaluate_results_dictionary, evaluate_runs, mean_relative_error_per_height, summarize_runs
 from locations_taxonomy import LocationsTaxonomy
+from projection import RECONSTRUCTION_BLOCK_SIZE, DenseProjection, SeededProjection
 from simulation import simulate_static_situation
-from user import SystemUser
-from utils import timing
+from user import UsersPopulation, batch_local_reports
+from profiling import profiled, span
+from utils import ESTIMATED_TREE_COUNTS, REAL_COUNTS_LIST, REAL_TREE_COUNTS, get_generator
 
 SMALL_NUMBER = 0.0001
+# the most reports (users * runs) randomized at once in the monte carlo runs - bounds their memory
+MONTE_CARLO_BLOCK_SIZE = 2 ** 22
+# reports fewer than 1 / SPARSE_ACCUMULATION_RATIO of m are added to z one by one, instead of by a bincount over m
+SPARSE_ACCUMULATION_RATIO = 16
 
 
-def basic_clusteting(users_list: List[SystemUser]):
+def basic_clusteting(users: UsersPopulation):
     '''
     users are clustered by their tau - the place they are ok with showing to the system.
-    :param users_list: the users to cluster
-    :return: a dictionary - for each tau - the users under it
+    :param users: the users to cluster
+    :return: a dictionary - for each tau index - the users under it (as views of the population)
     '''
-    users_clustering = dict()
-    for user in users_list:
-        if user.tau in users_clustering:
-            users_clustering[user.tau].append(user)
+    return users.group_by_tau()
+
+def calc_pce_parameters(beta, number_of_users, tau_leaves_num):
+    '''
+    the closed form bounds of the algorithm
+    :param beta: the accuracy parameter
+    :param number_of_users: number of users in the cluster
+    :param tau_leaves_num: number of leaves under the tau of the cluster
+    :return: delta, and m - the number of rows of phi
+    '''
+    delta = math.sqrt(math.log(2 * tau_leaves_num / beta) / number_of_users)
+    m = int(math.log(tau_leaves_num + 1) * math.log(2 / beta) / (delta ** 2))
+    return delta, m
+
+
+class TauPCEServer:
+    '''
+    the server of a single tau, as a state - it keeps phi and the accumulator z, so the reports of the users can be
+    added (or retracted, when a user leaves) as they arrive, and the counts can be asked for at any moment
+    without going over the past reports.
+    '''
+    def __init__(self, tau_index, taxonomy: LocationsTaxonomy, m, implicit_phi=False, rng=None):
+        '''
+        :param tau_index: the index of the tau node of the server
+        :param taxonomy: the taxonomy we build on
+        :param m: number of rows of phi
+        :param implicit_phi: if True - phi is defined by a seed and generated on demand instead of materialized,
+        so the users only need the seed and their row index j
+        :param rng: numpy Generator, drawn from the global seed if None - kept for the assignments of the rows
+        '''
+        rng = get_generator(rng)
+        self.rng = rng
+        self.tau_index = tau_index
+        self.leaves_node_indices = taxonomy.get_leaves_node_indices(tau_index)
+        self.m = m
+        leaves_num = len(self.leaves_node_indices)
+        with span('phi_generation', m=m, leaves=leaves_num) as phi_span:
+            if implicit_phi:
+                self.phi = SeededProjection(rng.integers(2 ** 63), m, leaves_num)
+            else:
+                self.phi = DenseProjection(m, leaves_num, rng=rng)
+            phi_span.add(bytes=self.phi.nbytes)
+        self.z = np.zeros(m)
+        self.reports_num = 0
+        # every change of z starts a new epoch - the leaves counts reconstructed in the current one are memoized.
+        # the memo is dropped, not cleared, so a report costs the same whatever the number of leaves is
+        self.epoch = 0
+        self._cached_counts = None
+
+    @staticmethod
+    def for_expected_users(beta, expected_users_num, tau_index, taxonomy: LocationsTaxonomy, implicit_phi=False,
+                           rng=None):
+        '''
+        :param beta: the accuracy parameter
+        :param expected_users_num: the number of users m is calculated for
+        :return: a server with the m of the closed form bounds
+        '''
+        _, m = calc_pce_parameters(beta, expected_users_num, taxonomy.get_number_leaves(tau_index))
+        return TauPCEServer(tau_index, taxonomy, m, implicit_phi=implicit_phi, rng=rng)
+
+    def assign_rows(self, size=None, rng=None):
+        '''
+        :param size: number of users to assign rows to, a single row if None
+        :param rng: numpy Generator, the one of the server if None
+        :return: the random row(s) j of phi the user(s) should be asked about
+        '''
+        return (self.rng if rng is None else rng).integers(self.m, size=size)
+
+    def get_row(self, j):
+        # what is sent to the user that was assigned to row j (with implicit phi - the seed is enough to rebuild it)
+        return self.phi[j, :]
+
+    def get_leaf_ids(self, location_indices):
+        # converts between the ids of the nodes and the ids of the leaves in the subtree of tau
+        return np.searchsorted(self.leaves_node_indices, location_indices)
+
+    def add_reports(self, rows, zis):
+        '''
+        :param rows: the row j (or rows) each report answers
+        :param zis: the report z_i (or reports) of the users
+        '''
+        self._accumulate(rows, zis, 1)
+
+    def retract_reports(self, rows, zis):
+        # a user left - its report is taken out of the accumulator
+        self._accumulate(rows, zis, -1)
+
+    def _accumulate(self, rows, zis, sign):
+        rows = np.atleast_1d(rows)
+        zis = sign * np.atleast_1d(zis).astype(float)
+        if len(rows) * SPARSE_ACCUMULATION_RATIO < self.m:
+            # a few reports (a churn) - added in place, without a pass over all of z
+            np.add.at(self.z, rows, zis)
         else:
-            users_clustering[user.tau] = [user]
-    return users_clustering
+            self.z += np.bincount(rows, weights=zis, minlength=self.m)
+        self.reports_num += sign * len(rows)
+        self._new_epoch()
+
+    def _new_epoch(self):
+        self.epoch += 1
+        self._cached_counts = None
+
+    def _estimate_leaf_ids_counts(self, leaf_ids):
+        if self._cached_counts is None:
+            # the first query of the epoch
+            self._cached_counts = np.full(self.phi.leaves_num, np.nan)
+        missing = np.unique(leaf_ids[np.isnan(self._cached_counts[leaf_ids])])
+        if len(missing) > 0:
+            with span('reconstruction', m=self.m, leaves=len(missing)):
+                self._cached_counts[missing] = self.phi.reconstruct(self.z, cols=missing)
+        return self._cached_counts[leaf_ids]
+
+    def estimate_counts(self):
+        '''
+        :return: the count estimation of every leaf under tau, by the reports till now - O(m * leaves)
+        '''
+        return self._estimate_leaf_ids_counts(np.arange(self.phi.leaves_num))
+
+    def estimate_leaves_counts(self, location_indices):
+        '''
+        only the requested leaves are reconstructed - O(m * requested leaves), and memoized till the next report
+        :param location_indices: indices of leaves under tau
+        :return: the count estimation of these leaves
+        '''
+        return self._estimate_leaf_ids_counts(self.get_leaf_ids(np.atleast_1d(location_indices)))
+
+    def top_k_leaves(self, k, block_size=RECONSTRUCTION_BLOCK_SIZE):
+        '''
+        the busiest leaves under tau - the columns are reconstructed block by block, keeping only the best k,
+        so the reconstruction memory is bounded by the block.
+        there is no pruning inside a tau: every column is reconstructed, O(m * leaves) as estimate_counts - the
+        reports bound no single leaf before its column is reconstructed. only top_k_heavy_hitters skips whole servers.
+        :param k: number of leaves
+        :param block_size: number of leaves reconstructed at once
+        :return: indices of the k leaves with the highest estimations, and their estimations (highest first)
+        '''
+        best_leaf_ids = np.array([], dtype=np.int64)
+        for start in range(0, self.phi.leaves_num, block_size):
+            leaf_ids = np.concatenate([best_leaf_ids, np.arange(start, min(start + block_size, self.phi.leaves_num))])
+            counts = self._estimate_leaf_ids_counts(leaf_ids)
+            best_leaf_ids = leaf_ids[np.argsort(-counts, kind='stable')[:k]]
+        return self.leaves_node_indices[best_leaf_ids], self._cached_counts[best_leaf_ids]
+
+
+def top_k_heavy_hitters(servers, k):
+    '''
+    the k busiest leaves over many tau servers - without reconstructing the servers that can not have them:
+    the estimations are clipped to [0, number of reports of the server], so once the k-th best estimation is at least
+    the number of reports of the next (smaller) server, no leaf of it can be in the top k.
+    a server that is reconstructed is reconstructed fully (see TauPCEServer.top_k_leaves) - so a single large tau
+    still costs O(m * leaves).
+    :param servers: TauPCEServer of different taus
+    :param k: number of leaves
+    :return: indices of the k busiest leaves, and their estimations (highest first)
+    '''
+    best_indices = np.array([], dtype=np.int64)
+    best_counts = np.array([])
+    for server in sorted(servers, key=lambda tau_server: tau_server.reports_num, reverse=True):
+        if len(best_counts) == k and best_counts[-1] >= server.reports_num:
+            break
+        indices, counts = server.top_k_leaves(k)
+        counts = np.clip(counts, 0, server.reports_num)
+        best_indices = np.concatenate([best_indices, indices])
+        best_counts = np.concatenate([best_counts, counts])
+        order = np.argsort(-best_counts, kind='stable')[:k]
+        best_indices, best_counts = best_indices[order], best_counts[order]
+    return best_indices, best_counts
+
+
+def monte_carlo_reconstruction(server: TauPCEServer, users: UsersPopulation, runs, cols=None, rng=None):
+    '''
+    many independent randomizations of the same users with the same phi - every run draws its own rows and signs,
+    z is an (m, runs) matrix, and all the runs are reconstructed at once by a single pass over phi (phi.T @ z)
+    :param server: the server of the cluster - only its phi is used, its accumulator is left as it is
+    :param users: the users of the cluster
+    :param runs: number of runs
+    :param cols: the leaf ids to reconstruct, all of them if None
+    :param rng: numpy Generator, drawn from the global seed if None
+    :return: the count estimations of the leaves - (runs, leaves)
+    '''
+    rng = get_generator(rng)
+    leaf_ids = server.get_leaf_ids(users.location_indices)
+    z = np.zeros((server.m, runs))
+    block_runs = max(1, MONTE_CARLO_BLOCK_SIZE // max(len(users), 1))
+    for start in range(0, runs, block_runs):
+        end = min(start + block_runs, runs)
+        with span('client_randomization', users=len(users), m=server.m, runs=end - start):
+            rows = server.assign_rows((end - start, len(users)), rng=rng)
+            zis = batch_local_reports(server.phi, rows, leaf_ids, users.epsilons, server.m, rng=rng)
+            # the rows of every run are shifted to their own range, so one bincount sums all the runs
+            runs_rows = rows + server.m * np.arange(end - start)[:, None]
+            z[:, start:end] = np.bincount(runs_rows.ravel(), weights=zis.ravel(),
+                                          minlength=server.m * (end - start)).reshape(end - start, server.m).T
+    with span('reconstruction', m=server.m, leaves=server.phi.leaves_num if cols is None else len(cols), runs=runs):
+        return server.phi.reconstruct(z, cols=cols).T
 
-def server_pce(beta, users: List[SystemUser], taxonomy: LocationsTaxonomy):
+
+def server_pce(beta, users: UsersPopulation, taxonomy: LocationsTaxonomy, implicit_phi=False, rng=None, m=None,
+               tau_index=None, runs=None):
     '''
     This is the function that runs it all - the server:
     1. get all the taus of all the users in the clusterand make sure they are the same
-    2. converts between the ids of the leaves in the subtree and the ids of the nodes
-    3. calculates everything needed for the algorithm
-    4. for each user - it asks the user itself (as in user.local_randomizer() for its data) - (this happens in the client side)
-    5. translate all the counts back to the current tau's size
+    2. calculates everything needed for the algorithm, and makes a server for tau
+    3. for each user - it asks the user itself (as in user.local_randomizer() for its data) - (this happens in the client side)
+       here it is simulated for the whole cluster at once with batch_local_reports()
+    4. reconstruct the counts of all the leaves under tau at once
 
     :param beta: the accuracy parameter
     :param users: all the users in the cluster.
     :param taxonomy: the taxonomy we build on.
-    :return: count estimation fot tau, as all its users are in this cluster.
+    :param implicit_phi: generate phi on demand from a seed instead of materializing it
+    :param rng: numpy Generator for all the randomness of the cluster, drawn from the global seed if None
+    :param m: number of rows of phi (see planner.plan_pce), the closed form bound if None
+    :param tau_index: the tau of the server - a common ancestor of the taus of the users when tiny clusters were
+    merged, the tau of the users if None
+    :param runs: number of independent randomizations of the users to estimate at once (see
+    monte_carlo_reconstruction), a single one if None
+    :return: the indices of the leaves under tau (the cached view of the taxonomy), and the count estimation of
+    each of them as a dense vector - as all the users of tau are in this cluster (of shape (runs, leaves) for runs).
+    for a merged cluster - only the leaves under the taus of its users are estimated.
     '''
-    taus = [user.tau for user in users]
-    taus_indices = [t.index for t in taus]
-    assert len(np.unique(taus_indices)) == 1
-    tau = taus[0]
-    tau_leaves_num = taxonomy.get_number_leaves(tau)
+    users_taus = np.unique(users.tau_indices)
+    if tau_index is None:
+        assert len(users_taus) == 1
+        tau_index = int(users_taus[0])
+    rng = get_generator(rng)
+    if m is None:
+        server = TauPCEServer.for_expected_users(beta, len(users), tau_index, taxonomy, implicit_phi=implicit_phi,
+                                                 rng=rng)
+    else:
+        server = TauPCEServer(tau_index, taxonomy, m, implicit_phi=implicit_phi, rng=rng)
+    merged = len(users_taus) > 1 or users_taus[0] != tau_index
+    # the server knows the taus of the users - the other leaves of its tau have no users of this cluster
+    leaves_node_indices = np.concatenate([taxonomy.get_leaves_node_indices(int(tau)) for tau in users_taus]) \
+        if merged else server.leaves_node_indices
 
-    node_ids = [i for (i, _) in taxonomy.get_leaves_enumerated(tau)]
-    node_ids = list(sorted(node_ids))
-    node_id_to_leaf_id = {node_ids[index]: index for index in range(len(node_ids))}
+    if runs is not None:
+        cols = server.get_leaf_ids(leaves_node_indices) if merged else None
+        counts = monte_carlo_reconstruction(server, users, runs, cols=cols, rng=rng)
+        return leaves_node_indices, counts.astype(np.int64)
 
-    number_of_users = len(users)
+    # each user is asked about a random row j, and the whole cluster is randomized at once
+    with span('client_randomization', users=len(users), m=server.m):
+        rows = server.assign_rows(len(users), rng=rng)
+        zis = batch_local_reports(server.phi, rows, server.get_leaf_ids(users.location_indices), users.epsilons,
+                                  server.m, rng=rng)
+    server.add_reports(rows, zis)
 
-    delta = math.sqrt(math.log(2 * tau_leaves_num / beta) / number_of_users)
-    m = int(math.log(tau_leaves_num + 1) * math.log(2 / beta) / (delta ** 2))
-    phi = np.random.choice([-1 / math.sqrt(m), 1 / math.sqrt(m)], size=(m, tau_leaves_num), p=[0.5, 0.5])
-    m_list = [i for i in range(m)]
-    z = np.zeros((m, 1))
+    if merged:
+        return leaves_node_indices, server.estimate_leaves_counts(leaves_node_indices).astype(np.int64)
+    return leaves_node_indices, server.estimate_counts().astype(np.int64)
+
+def hierarchical_counts(taxonomy: LocationsTaxonomy, leaf_counts, clusters_sizes):
+    '''
+    the count estimation of every node of the taxonomy, from the estimations of the leaves.
+    the server knows exactly how many users are in every tau cluster - so first the leaves estimations of every
+    cluster are made consistent with it (the least squares correction - the difference is spread evenly over its
+    leaves), and then every node is the sum of its leaves, so children always sum to their parents.
+    :param taxonomy: the taxonomy we build on
+    :param leaf_counts: the estimated counts per leaf id
+    :param clusters_sizes: a dictionary - for each tau index - the number of users in its cluster
+    :return: the estimated counts per node index
+    '''
+    leaf_counts = np.asarray(leaf_counts, dtype=np.float64).copy()
+    taus = np.fromiter(clusters_sizes.keys(), dtype=np.int64, count=len(clusters_sizes))
+    sizes = np.fromiter(clusters_sizes.values(), dtype=np.float64, count=len(clusters_sizes))
+    estimated_sizes = taxonomy.aggregate_leaf_counts(leaf_counts)[taus]
+    leaves_nums = taxonomy.leaves_end[taus] - taxonomy.leaves_start[taus]
+    corrections = np.zeros(len(leaf_counts) + 1)
+    np.add.at(corrections, taxonomy.leaves_start[taus], (sizes - estimated_sizes) / leaves_nums)
+    np.subtract.at(corrections, taxonomy.leaves_end[taus], (sizes - estimated_sizes) / leaves_nums)
+    leaf_counts += np.cumsum(corrections)[:-1]
+    return taxonomy.aggregate_leaf_counts(leaf_counts)
+
+
+class DynamicPCE:
+    '''
+    the estimation of a population that keeps changing - the servers of the taus and the report of every user are
+    kept, so the users that leave or join are applied as increments of the accumulators (phi and the reports of the
+    users that stayed are reused), and the change of the counts is estimated from the increments alone.
+    the randomization and the accumulators work of a change are proportional to the churn, not to the population.
+    '''
+    def __init__(self, users: UsersPopulation, taxonomy: LocationsTaxonomy, beta, implicit_phi=False, rng=None):
+        '''
+        :param users: the users at the start
+        :param taxonomy: the taxonomy we build on
+        :param beta: the accuracy param - m of every tau is calculated for the number of its users at the start
+        :param implicit_phi: generate phi on demand from a seed instead of materializing it
+        :param rng: numpy Generator, drawn from the global seed if None
+        '''
+        self.taxonomy = taxonomy
+        self.beta = beta
+        self.implicit_phi = implicit_phi
+        self.rng = get_generator(rng)
+        self.servers = {}
+        # the users that ever joined, in order, and the report of each - the ones that left are only marked.
+        # the columns have spare capacity that grows by doubling, so a change only writes the users it adds
+        self._size = 0
+        self._columns = {'epsilons': np.zeros(0), 'tau_indices': np.zeros(0, dtype=np.int64),
+                         'location_indices': np.zeros(0, dtype=np.int64), 'rows': np.zeros(0, dtype=np.int64),
+                         'zis': np.zeros(0), 'active': np.zeros(0, dtype=bool)}
+        self._add_users(users, {})
+
+    @property
+    def users(self):
+        # a view of the users that ever joined
+        return UsersPopulation(self._columns['epsilons'][:self._size], self._columns['tau_indices'][:self._size],
+                               self._columns['location_indices'][:self._size])
+
+    @property
+    def rows(self):
+        return self._columns['rows'][:self._size]
+
+    @property
+    def zis(self):
+        return self._columns['zis'][:self._size]
+
+    @property
+    def active(self):
+        return self._columns['active'][:self._size]
+
+    def _append(self, users: UsersPopulation, rows, zis):
+        size = self._size + len(users)
+        capacity = len(self._columns['rows'])
+        if size > capacity:
+            capacity = max(size, 2 * capacity)
+            for name, column in self._columns.items():
+                grown = np.zeros(capacity, dtype=column.dtype)
+                grown[:self._size] = column[:self._size]
+                self._columns[name] = grown
+        new = slice(self._size, size)
+        self._columns['epsilons'][new] = users.epsilons
+        self._columns['tau_indices'][new] = users.tau_indices
+        self._columns['location_indices'][new] = users.location_indices
+        self._columns['rows'][new] = rows
+        self._columns['zis'][new] = zis
+        self._columns['active'][new] = True
+        self._size = size
+
+    def _add_users(self, users: UsersPopulation, deltas):
+        rows = np.zeros(len(users), dtype=np.int64)
+        zis = np.zeros(len(users))
+        for tau_index, indices in users.group_indices_by_tau().items():
+            if tau_index not in self.servers:
+                self.servers[tau_index] = TauPCEServer.for_expected_users(self.beta, len(indices), tau_index,
+                                                                          self.taxonomy,
+                                                                          implicit_phi=self.implicit_phi, rng=self.rng)
+            server = self.servers[tau_index]
+            tau_users = users[indices]
+            with span('client_randomization', users=len(indices), m=server.m):
+                rows[indices] = server.assign_rows(len(indices), rng=self.rng)
+                zis[indices] = batch_local_reports(server.phi, rows[indices],
+                                                   server.get_leaf_ids(tau_users.location_indices),
+                                                   tau_users.epsilons, server.m, rng=self.rng)
+            server.add_reports(rows[indices], zis[indices])
+            deltas.setdefault(tau_index, []).append((rows[indices], zis[indices]))
+        self._append(users, rows, zis)
+
+    def _remove_users(self, indices, deltas):
+        indices = np.asarray(indices, dtype=np.int64)
+        assert self.active[indices].all()
+        self.active[indices] = False
+        for tau_index, tau_indices in self.users[indices].group_indices_by_tau().items():
+            server = self.servers[tau_index]
+            rows, zis = self.rows[indices[tau_indices]], self.zis[indices[tau_indices]]
+            server.retract_reports(rows, zis)
+            deltas.setdefault(tau_index, []).append((rows, -zis))
+
+    def _covered_leaves(self):
+        covered_leaves = np.zeros(len(self.taxonomy.leaves_node_indices), dtype=bool)
+        for tau_index in self.servers.keys():
+            start, end = self.taxonomy.get_leaves_range(tau_index)
+            covered_leaves[start:end] = True
+        return covered_leaves
 
-    for user in users:
-        j = random.choice(m_list)
-        phi_jth_row = phi[j, :]
-        zi = user.local_randomizer(phi_jth_row, node_id_to_leaf_id, m)
-        z[j, 0] += zi
+    def apply_changes(self, deleted_indices, added_users: UsersPopulation):
+        '''
+        :param deleted_indices: the indices of the users that left (in the order the users joined)
+        :param added_users: the users that joined
+        :return: the real and the estimated change of the count of every leaf id (after - before), and a mask of the
+        leaves under the taus of the servers
+        '''
+        # for every tau - the rows and the (signed) reports of its churn, a sparse change of its accumulator
+        deltas = {}
+        removed = self.users[np.asarray(deleted_indices, dtype=np.int64)]
+        self._remove_users(deleted_indices, deltas)
+        self._add_users(added_users, deltas)
 
-    f = {key: 0 for key in node_id_to_leaf_id.keys()}
-    for i, leaf in taxonomy.get_leaves_enumerated(tau):
-        f[i] = int(np.dot(z.T, phi[:, node_id_to_leaf_id[i]]))
-    return f
+        leaves_num = len(self.taxonomy.leaves_node_indices)
+        real_change = np.bincount(self.taxonomy.get_leaf_ids(added_users.location_indices), minlength=leaves_num) - \
+            np.bincount(self.taxonomy.get_leaf_ids(removed.location_indices), minlength=leaves_num)
+        estimated_change = np.zeros(leaves_num)
+        for tau_index, tau_deltas in deltas.items():
+            start, end = self.taxonomy.get_leaves_range(tau_index)
+            rows, zis = (np.concatenate(column) for column in zip(*tau_deltas))
+            # only the rows of the churn changed - so only they are reconstructed
+            changed_rows, inverse = np.unique(rows, return_inverse=True)
+            delta_z = np.bincount(inverse, weights=zis, minlength=len(changed_rows))
+            with span('reconstruction', m=len(changed_rows), leaves=end - start):
+                estimated_change[start:end] = self.servers[tau_index].phi.reconstruct(delta_z, rows=changed_rows)
+        return real_change, estimated_change, self._covered_leaves()
 
-@timing
-def pce_runner(users, taxonomy, beta, **args):
+    def estimate_counts(self):
+        '''
+        :return: the real and the estimated count of every leaf id by the users now, and a mask of the leaves under
+        the taus of the servers
+        '''
+        leaves_num = len(self.taxonomy.leaves_node_indices)
+        real_counts = np.bincount(self.taxonomy.get_leaf_ids(self.users.location_indices[self.active]),
+                                  minlength=leaves_num)
+        estimated_counts = np.zeros(leaves_num, dtype=np.int64)
+        for tau_index, server in self.servers.items():
+            start, end = self.taxonomy.get_leaves_range(tau_index)
+            estimated_counts[start:end] = server.estimate_counts().astype(np.int64)
+        return real_counts, estimated_counts, self._covered_leaves()
+
+    def evaluate(self):
+        # the evaluation of the estimation now, as pce_runner returns
+        real_counts, estimated_counts, covered_leaves = self.estimate_counts()
+        with span('evaluation', leaves=int(covered_leaves.sum())):
+            return evaluate_results_dictionary(real_counts[covered_leaves], estimated_counts[covered_leaves])
+
+
+def estimate_clusters(users, taxonomy, beta, implicit_phi=False, workers=1, random_seed=None, plan=None, runs=None):
+    '''
+    clusters the users by their tau and estimates every cluster (the params are as in pce_runner)
+    :param runs: number of independent randomizations of the users to estimate at once, a single one if None
+    :return: the clusters, the real counts per leaf id, the estimated counts per leaf id (of shape (runs, leaves)
+    for runs) and the leaves covered by the clusters
+    '''
+    with span('clustering', users=len(users)) as clustering_span:
+        users_clustering_by_taus = basic_clusteting(users)
+        clustering_span.add(clusters=len(users_clustering_by_taus))
+    if random_seed is None:
+        random_seed = int(get_generator().integers(2 ** 63))
+    if plan is not None:
+        implicit_phi = plan.implicit_phi
+    if plan is None:
+        servers_users = users_clustering_by_taus
+    else:
+        # the users of the tiny taus merged by the plan are estimated together
+        servers_rows = {}
+        for tau_index, tau_rows in users.group_indices_by_tau().items():
+            servers_rows.setdefault(plan.cluster_of(tau_index), []).append(tau_rows)
+        servers_users = {tau_index: users[np.concatenate(rows)] for tau_index, rows in servers_rows.items()}
+
+    def cluster_pce(tau_index):
+        rng = np.random.default_rng([random_seed, tau_index])
+        if plan is None:
+            return server_pce(beta, servers_users[tau_index], taxonomy, implicit_phi=implicit_phi, rng=rng,
+                              runs=runs)
+        return server_pce(beta, servers_users[tau_index], taxonomy, implicit_phi=implicit_phi, rng=rng,
+                          m=plan.get_cluster(tau_index)['m'], tau_index=tau_index, runs=runs)
+
+    # the largest clusters first, so the small ones fill the gaps at the end
+    taus_by_size = sorted(servers_users.keys(), key=lambda tau: len(servers_users[tau]), reverse=True)
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            clusters_counts = dict(zip(taus_by_size, executor.map(cluster_pce, taus_by_size)))
+    else:
+        clusters_counts = {tau_index: cluster_pce(tau_index) for tau_index in taus_by_size}
+
+    # counts are kept per leaf id - the leaves of every tau are a contiguous range of it
+    leaves_num = len(taxonomy.leaves_node_indices)
+    final_counts = np.zeros(leaves_num if runs is None else (runs, leaves_num), dtype=np.int64)
+    final_real_counts = np.zeros(leaves_num, dtype=np.int64)
+    covered_leaves = np.zeros(leaves_num, dtype=bool)
+    for tau_index, tau_users in users_clustering_by_taus.items():
+        start, end = taxonomy.get_leaves_range(tau_index)
+        users_leaf_ids = taxonomy.get_leaf_ids(tau_users.location_indices)
+        assert ((start <= users_leaf_ids) & (users_leaf_ids < end)).all()
+        final_real_counts[start:end] = np.bincount(users_leaf_ids - start, minlength=end - start)
+    for leaves_node_indices, counts in clusters_counts.values():
+        leaf_ids = taxonomy.get_leaf_ids(leaves_node_indices)
+        final_counts[..., leaf_ids] = counts
+        covered_leaves[leaf_ids] = True
+    return users_clustering_by_taus, final_real_counts, final_counts, covered_leaves
+
+
+@profiled
+def pce_runner(users, taxonomy, beta, implicit_phi=False, workers=1, random_seed=None, hierarchical=False, plan=None,
+               **args):
     '''
     This is the runner of the experiment inside the server
     it is taking all the users and clustering only by their tau (that is achievacle by the server)
@@ -80,27 +514,56 @@ def pce_runner(users, taxonomy, beta, **args):
     :param users: the users to ask for taus
     :param taxonomy: the taxonomy of the server now
     :param beta: te accuracy param
+    :param implicit_phi: generate phi on demand from a seed instead of materializing it
+    :param workers: number of threads the clusters are estimated in (numpy releases the GIL in the heavy parts)
+    :param random_seed: the seed every cluster's randomness is derived from (by its tau), so the results do not depend
+    on the number of workers. drawn from the global seed if None
+    :param hierarchical: also estimate the counts of every node of the taxonomy (see hierarchical_counts)
+    :param plan: the clusters and the m of each (see planner.plan_pce), the clusters of the taus with the closed
+    form m if None. the plan also decides implicit_phi - its predictions are of its own kind of phi
     :param args: other params, for easy usage of the function
     :return: the evaluation of the results of the counts vs. the fincal counts
     '''
-    users_clustering_by_taus = basic_clusteting(users)
-    final_counts = {}
-    final_real_counts = {}
-    for tau in users_clustering_by_taus.keys():
-        indices_nodes_tau_leaves = taxonomy.get_leaves_enumerated(tau)
-        real_f = dict()
-        for index, node in indices_nodes_tau_leaves:
-            real_f[index] = 0
-        for user in users_clustering_by_taus[tau]:
-            if user.location_index in real_f:
-                real_f[user.location_index] += 1
-            else:
-                assert False
-        f = server_pce(beta, users_clustering_by_taus[tau], taxonomy)
-        final_counts.update(f)
-        final_real_counts.update(real_f)
+    users_clustering_by_taus, final_real_counts, final_counts, covered_leaves = estimate_clusters(
+        users, taxonomy, beta, implicit_phi=implicit_phi, workers=workers, random_seed=random_seed, plan=plan)
+
+    with span('evaluation', leaves=int(covered_leaves.sum())):
+        results_dictionary = evaluate_results_dictionary(final_real_counts[covered_leaves],
+                                                         final_counts[covered_leaves])
+    if hierarchical:
+        with span('hierarchical', nodes=taxonomy.max_index):
+            clusters_sizes = {tau_index: len(tau_users) for tau_index, tau_users in users_clustering_by_taus.items()}
+            results_dictionary[ESTIMATED_TREE_COUNTS] = hierarchical_counts(taxonomy, final_counts, clusters_sizes)
+            results_dictionary[REAL_TREE_COUNTS] = taxonomy.aggregate_leaf_counts(final_real_counts)
+            _, results_dictionary['mean_relative_error_per_height'] = mean_relative_error_per_height(
+                results_dictionary[ESTIMATED_TREE_COUNTS], results_dictionary[REAL_TREE_COUNTS], taxonomy.heights)
+    return results_dictionary
+
 
-    results_dictionary = evaluate_results_dictionary(final_real_counts, final_counts)
+@profiled
+def pce_monte_carlo(users, taxonomy, beta, runs=100, implicit_phi=False, workers=1, random_seed=None, plan=None,
+                    confidence=0.95, **args):
+    '''
+    the error distribution of the estimator on a single population - the population, its clustering and phi are
+    kept, and only the randomization of the users is repeated, runs times, all at once (see
+    monte_carlo_reconstruction) - instead of a whole pce_runner per seed
+    :param runs: number of randomizations
+    :param confidence: the confidence level of the intervals
+    :param args: the params of pce_runner
+    :return: for every metric of evaluate_runs - its value in every run, with its mean, std and intervals (see
+    summarize_runs), and the mean and std of the estimation of every leaf
+    '''
+    _, final_real_counts, final_counts, covered_leaves = estimate_clusters(
+        users, taxonomy, beta, implicit_phi=implicit_phi, workers=workers, random_seed=random_seed, plan=plan,
+        runs=runs)
+    estimated_counts = final_counts[:, covered_leaves]
+    with span('evaluation', leaves=int(covered_leaves.sum()), runs=runs):
+        results_dictionary = summarize_runs(evaluate_runs(estimated_counts, final_real_counts[covered_leaves]),
+                                            confidence=confidence)
+    results_dictionary[REAL_COUNTS_LIST] = final_real_counts[covered_leaves]
+    results_dictionary['estimated_counts_mean'] = estimated_counts.mean(axis=0)
+    results_dictionary['estimated_counts_std'] = estimated_counts.std(axis=0)
+    results_dictionary['runs'] = runs
     return results_dictionary
 
 if __name__ == '__main__':
@@ -0,0 +1,262 @@
+import contextlib
+import io
+import math
+import time
+
+import numpy as np
+
+from locations_taxonomy import LocationsTaxonomy
+from personalized_count_estimator import TauPCEServer, calc_pce_parameters, pce_runner
+from simulation import simulate_static_situation
+from user import _calc_c_epsilon
+from utils import get_generator
+
+PREDICTION_DRAWS = 2 ** 15
+PREDICTION_SEED = 0
+# the collision noise allowed over the privacy noise (see leaf_error_variance) when there is no target - 5% more
+# variance, so the error is at most 2.5% over the best any m can reach
+DEFAULT_COLLISION_RATIO = 0.05
+MAX_COLLISION_RATIO = 2 ** 40
+# the seconds of every unit of work of a cluster, as measured by calibrate_cost_model on a laptop
+DEFAULT_COST_MODEL = {False: {'cluster': 2.7e-4, 'report': 3.5e-7, 'phi_entry': 1.5e-8, 'reconstruction_entry': 9e-9},
+                      True: {'cluster': 2.9e-4, 'report': 3e-7, 'phi_entry': 0, 'reconstruction_entry': 2e-8}}
+
+
+def privacy_variance(cluster_size, leaves_num, mean_c_eps_square):
+    # the noise every user adds to every leaf by its randomization (c_eps^2) - the same whatever m is
+    return cluster_size * mean_c_eps_square - cluster_size / leaves_num
+
+
+def collision_pairs(cluster_size, leaves_num):
+    # the expected number of pairs of users of the same leaf (another leaf than the estimated one)
+    return cluster_size * (cluster_size - 1) * (leaves_num - 1) / leaves_num ** 2
+
+
+def leaf_error_variance(cluster_size, leaves_num, m, mean_c_eps_square):
+    '''
+    the variance of the estimation of a leaf, with the users spread evenly over the leaves - the privacy noise, and
+    the noise of the pairs of users of the same leaf that were asked about the same row (1 / m of the pairs) - the
+    only part m controls.
+    :param cluster_size: number of users in the cluster
+    :param leaves_num: number of leaves under the tau of the cluster
+    :param m: number of rows of phi
+    :param mean_c_eps_square: the mean of c_eps^2 over the users
+    :return: the variance
+    '''
+    return privacy_variance(cluster_size, leaves_num, mean_c_eps_square) + collision_pairs(cluster_size, leaves_num) / m
+
+
+def mean_c_eps_square(epsilons):
+    # the users are assumed to be spread evenly over the epsilons, as in the simulation
+    c_eps, _ = _calc_c_epsilon(np.atleast_1d(np.asarray(epsilons, dtype=float)))
+    return float(np.mean(c_eps ** 2))
+
+
+class _ErrorPredictor:
+    '''
+    the MRE of a cluster as a function of m, over simulated estimations - the real counts and the standard normal
+    noise are drawn once, so the predictions of different m's are comparable.
+    '''
+    def __init__(self, cluster_size, leaves_num, c_eps_square, draws=PREDICTION_DRAWS, rng=None):
+        rng = get_generator(rng)
+        self.cluster_size = cluster_size
+        self.leaves_num = leaves_num
+        self.c_eps_square = c_eps_square
+        samples = max(1, draws // leaves_num)
+        self.real_counts = rng.multinomial(cluster_size, np.full(leaves_num, 1 / leaves_num), size=samples)
+        self.noise = rng.standard_normal((samples, leaves_num))
+
+    def __call__(self, m):
+        std = math.sqrt(max(leaf_error_variance(self.cluster_size, self.leaves_num, m, self.c_eps_square), 0))
+        # as the estimations of server_pce - truncated to int
+        estimated_counts = np.abs((self.real_counts + std * self.noise).astype(np.int64))
+        return float(np.mean(np.abs(estimated_counts - self.real_counts) / np.maximum(estimated_counts, 1)))
+
+
+def _bisect(predicate, low, high, steps=20):
+    # the points around where the monotone predicate turns from True (low) to False (high) - searched in log scale
+    for _ in range(steps):
+        middle = math.sqrt(low * high)
+        low, high = (middle, high) if predicate(middle) else (low, middle)
+    return low, high
+
+
+class PCEPlan:
+    '''
+    the clusters to run and the m of each, with the predicted cost and error - the input of pce_runner(plan=...).
+    every cluster is a dictionary of: tau_index (the tau of the server), taus (the taus of its users - more than one
+    when tiny clusters were merged), users, leaves, m, closed_form_m, phi_bytes, predicted_seconds and
+    predicted_mean_relative_error.
+    '''
+    def __init__(self, clusters, collision_ratio=DEFAULT_COLLISION_RATIO, implicit_phi=False):
+        self.clusters = clusters
+        self.collision_ratio = collision_ratio
+        self.implicit_phi = implicit_phi
+        self._cluster_of = {tau: cluster['tau_index'] for cluster in clusters for tau in cluster['taus']}
+
+    def cluster_of(self, tau_index):
+        # the tau of the server that estimates the users of tau_index
+        return self._cluster_of[tau_index]
+
+    def get_cluster(self, tau_index):
+        return next(cluster for cluster in self.clusters if cluster['tau_index'] == tau_index)
+
+    @property
+    def phi_bytes(self):
+        return sum(cluster['phi_bytes'] for cluster in self.clusters)
+
+    @property
+    def predicted_seconds(self):
+        return sum(cluster['predicted_seconds'] for cluster in self.clusters)
+
+    @property
+    def predicted_mean_relative_error(self):
+        # the mean over all the leaves, as in pce_runner
+        leaves = sum(cluster['leaves'] for cluster in self.clusters)
+        return sum(cluster['predicted_mean_relative_error'] * cluster['leaves'] for cluster in self.clusters) / leaves
+
+    def summary(self):
+        return {'clusters': len(self.clusters), 'collision_ratio': self.collision_ratio,
+                'merged_clusters': sum(len(cluster['taus']) > 1 for cluster in self.clusters),
+                'm_total': sum(cluster['m'] for cluster in self.clusters),
+                'closed_form_m_total': sum(cluster['closed_form_m'] for cluster in self.clusters),
+                'phi_bytes': self.phi_bytes, 'predicted_seconds': self.predicted_seconds,
+                'predicted_mean_relative_error': self.predicted_mean_relative_error}
+
+
+def _merge_tiny_clusters(taxonomy: LocationsTaxonomy, clusters_sizes, merge_below):
+    '''
+    the clusters with less than merge_below users are merged with their tiny siblings, into a cluster of their parent
+    (the estimations are still only of the leaves of their own taus)
+    :return: for each tau of a server - the taus of its users
+    '''
+    groups = {}
+    for tau_index, size in clusters_sizes.items():
+        parent = int(taxonomy.parents[tau_index])
+        if merge_below is not None and size < merge_below and parent >= 0:
+            groups.setdefault(parent, []).append(tau_index)
+        else:
+            groups[tau_index] = [tau_index]
+    # a tiny cluster with no tiny sibling is left as it is
+    return {(tau_index if len(taus) > 1 else taus[0]): taus for tau_index, taus in groups.items()}
+
+
+def _cluster_cost(cost_model, users, phi_leaves, estimated_leaves, m, implicit_phi):
+    seconds = cost_model['cluster'] + cost_model['report'] * users + \
+        (cost_model['phi_entry'] * phi_leaves + cost_model['reconstruction_entry'] * estimated_leaves) * m
+    return seconds, 0 if implicit_phi else m * phi_leaves
+
+
+def plan_pce(taxonomy: LocationsTaxonomy, clusters_sizes, beta, epsilons, target_mean_relative_error=None,
+             memory_budget=None, latency_budget=None, merge_below=None, implicit_phi=False, cost_model=None,
+             draws=PREDICTION_DRAWS):
+    '''
+    picks m for every cluster, instead of the closed form bound - that grows with the users, while most of the error
+    of a leaf is the privacy noise, which does not depend on m at all (see leaf_error_variance).
+    all the clusters are planned with the same ratio of collision noise over privacy noise - the m of a cluster is the
+    one that keeps it at that ratio, capped by the closed form m. the ratio is DEFAULT_COLLISION_RATIO, or the largest
+    one the predicted MRE still reaches target_mean_relative_error with, raised further till the plan fits the budgets.
+    :param taxonomy: the taxonomy we build on
+    :param clusters_sizes: a dictionary - for each tau index - the number of users in its cluster
+    :param beta: the accuracy parameter, for the closed form m
+    :param epsilons: the epsilons of the users
+    :param target_mean_relative_error: the MRE (over all the leaves) to reach with the smallest m's
+    :param memory_budget: the most bytes of all the phi's together
+    :param latency_budget: the most predicted seconds of the whole run
+    :param merge_below: clusters with less users are merged with their tiny siblings (see _merge_tiny_clusters)
+    :param implicit_phi: phi is generated from a seed - no memory, slower reconstruction
+    :param cost_model: the seconds of every unit of work (see calibrate_cost_model), DEFAULT_COST_MODEL if None
+    :param draws: number of leaves estimations the MRE of every cluster is predicted over
+    :return: the plan
+    '''
+    cost_model = (cost_model or DEFAULT_COST_MODEL)[implicit_phi]
+    c_eps_square = mean_c_eps_square(epsilons)
+    rng = np.random.default_rng(PREDICTION_SEED)
+    clusters = []
+    for tau_index, taus in _merge_tiny_clusters(taxonomy, clusters_sizes, merge_below).items():
+        users = sum(clusters_sizes[tau] for tau in taus)
+        phi_leaves = taxonomy.get_number_leaves(tau_index)
+        leaves = sum(taxonomy.get_number_leaves(tau) for tau in taus)
+        _, closed_form_m = calc_pce_parameters(beta, users, phi_leaves)
+        clusters.append(dict(tau_index=int(tau_index), taus=[int(tau) for tau in taus], users=users, leaves=leaves,
+                             phi_leaves=phi_leaves, closed_form_m=max(closed_form_m, 1),
+                             predictor=_ErrorPredictor(users, leaves, c_eps_square, draws=draws, rng=rng)))
+
+    def cluster_m(cluster, ratio):
+        noise = ratio * privacy_variance(cluster['users'], cluster['leaves'], c_eps_square)
+        m = math.ceil(collision_pairs(cluster['users'], cluster['leaves']) / noise) if noise > 0 else 1
+        return int(min(max(m, 1), cluster['closed_form_m']))
+
+    def predicted_error(ratio):
+        leaves = sum(cluster['leaves'] for cluster in clusters)
+        return sum(cluster['predictor'](cluster_m(cluster, ratio)) * cluster['leaves'] for cluster in clusters) / leaves
+
+    def fits(ratio):
+        seconds, phi_bytes = 0, 0
+        for cluster in clusters:
+            cluster_seconds, cluster_bytes = _cluster_cost(cost_model, cluster['users'], cluster['phi_leaves'],
+                                                           cluster['leaves'], cluster_m(cluster, ratio), implicit_phi)
+            seconds, phi_bytes = seconds + cluster_seconds, phi_bytes + cluster_bytes
+        return (memory_budget is None or phi_bytes <= memory_budget) and \
+            (latency_budget is None or seconds <= latency_budget)
+
+    ratio = DEFAULT_COLLISION_RATIO
+    if target_mean_relative_error is not None and predicted_error(ratio) <= target_mean_relative_error:
+        ratio, _ = _bisect(lambda r: predicted_error(r) <= target_mean_relative_error, ratio, MAX_COLLISION_RATIO)
+    if not fits(ratio):
+        # m's of 1 may still not fit - then the plan is the cheapest there is
+        _, ratio = _bisect(lambda r: not fits(r), ratio, MAX_COLLISION_RATIO)
+
+    for cluster in clusters:
+        cluster['m'] = cluster_m(cluster, ratio)
+        cluster['predicted_mean_relative_error'] = cluster.pop('predictor')(cluster['m'])
+        cluster['predicted_seconds'], cluster['phi_bytes'] = _cluster_cost(
+            cost_model, cluster['users'], cluster['phi_leaves'], cluster['leaves'], cluster['m'], implicit_phi)
+    return PCEPlan(clusters, collision_ratio=ratio, implicit_phi=implicit_phi)
+
+
+def _timed(function, *args, repeats=3, **kwargs):
+    # the best of repeats runs, in seconds
+    seconds = float('inf')
+    for _ in range(repeats):
+        ts = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            function(*args, **kwargs)
+        seconds = min(seconds, time.perf_counter() - ts)
+    return seconds
+
+
+def calibrate_cost_model(taxonomy: LocationsTaxonomy, users_num=100000, m=1024, repeats=3):
+    '''
+    measures the seconds of every unit of work on this machine - of a cluster and of a user from whole runs of
+    pce_runner with m = 1 on two populations (the clusters of the lowest height), of phi and of the reconstruction
+    on the root as tau
+    :return: a cost model for plan_pce
+    '''
+    rng = np.random.default_rng(PREDICTION_SEED)
+    height = min(height for height in taxonomy.nodes_by_height.keys() if height > 0)
+    populations = [simulate_static_situation(taxonomy=taxonomy, num_users=num_users, height=height, random_seed=0)
+                   for num_users in (users_num // 10, users_num)]
+    cost_model = {}
+    for implicit_phi in (False, True):
+        runs = []
+        for inputs_dictionary, users in populations:
+            plan = PCEPlan([dict(tau_index=tau_index, taus=[tau_index], m=1)
+                            for tau_index in users.group_indices_by_tau().keys()], implicit_phi=implicit_phi)
+            runs.append((len(users), len(plan.clusters), _timed(pce_runner, users, plan=plan, random_seed=0,
+                                                                repeats=repeats, implicit_phi=implicit_phi,
+                                                                **inputs_dictionary)))
+        (small_users, _, small_seconds), (large_users, clusters, large_seconds) = runs
+        report = max(large_seconds - small_seconds, 0) / (large_users - small_users)
+
+        cluster = _timed(TauPCEServer, 0, taxonomy, 1, implicit_phi=implicit_phi, rng=rng, repeats=repeats)
+        phi = _timed(TauPCEServer, 0, taxonomy, m, implicit_phi=implicit_phi, rng=rng, repeats=repeats)
+        server = TauPCEServer(0, taxonomy, m, implicit_phi=implicit_phi, rng=rng)
+        server.add_reports(server.assign_rows(m, rng=rng), rng.standard_normal(m))
+        reconstruction = _timed(server.phi.reconstruct, server.z, repeats=repeats)
+        entries = m * server.phi.leaves_num
+        cost_model[implicit_phi] = {'cluster': max(large_seconds - report * large_users, 0) / clusters,
+                                    'report': report,
+                                    'phi_entry': 0 if implicit_phi else max(phi - cluster, 0) / entries,
+                                    'reconstruction_entry': reconstruction / entries}
+    return cost_model
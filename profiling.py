@@ -0,0 +1,195 @@
+import cProfile
+import csv
+import json
+import os
+import threading
+import time
+import tracemalloc
+from functools import wraps
+
+PROFILE_ENV_VAR = 'PRIVATE_PARKING_PROFILE'
+PROFILE_DIR_ENV_VAR = 'PRIVATE_PARKING_PROFILE_DIR'
+SPANS_MODE = 'spans'
+TRACEMALLOC_MODE = 'tracemalloc'
+CPROFILE_MODE = 'cprofile'
+
+_modes = set()
+_local = threading.local()
+_cprofile_pid = None  # the process a cProfile is running in - forked workers start their own
+
+
+def configure(modes=None):
+    '''
+    turns the instrumentation on or off. off - spans cost a single check and record nothing.
+    :param modes: comma separated - 'spans' for named spans with their times and counters, 'tracemalloc' to add
+    memory to the spans (of the main thread only - the memory of the other threads is in them), 'cprofile' to dump a
+    cProfile of every @profiled function. read from the PRIVATE_PARKING_PROFILE environment variable if None
+    ('1' is the same as 'spans')
+    '''
+    global _modes
+    if modes is None:
+        modes = os.environ.get(PROFILE_ENV_VAR, '')
+    _modes = {SPANS_MODE if mode.strip() == '1' else mode.strip().lower() for mode in modes.split(',') if mode.strip()}
+    if _modes:
+        _modes.add(SPANS_MODE)
+    if TRACEMALLOC_MODE in _modes and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def is_enabled():
+    return bool(_modes)
+
+
+class MetricsRegistry:
+    '''
+    the spans recorded in this process - a list of flat dictionaries, so they can be sent back from a worker
+    process (snapshot) and merged into the registry of the parent (merge).
+    '''
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def add(self, record):
+        with self._lock:
+            self.records.append(record)
+
+    def snapshot(self, clear=True):
+        '''
+        :param clear: clear the registry after taking the snapshot, so the next one has only the new spans
+        :return: the recorded spans
+        '''
+        with self._lock:
+            records = list(self.records)
+            if clear:
+                self.records = []
+        return records
+
+    def merge(self, records):
+        with self._lock:
+            self.records.extend(records)
+
+    def clear(self):
+        self.snapshot(clear=True)
+
+    def summary(self):
+        '''
+        :return: for every span name - the number of spans, their total seconds and the sums of their counters
+        '''
+        summary = {}
+        for record in self.records:
+            name_summary = summary.setdefault(record['name'], {'count': 0})
+            name_summary['count'] += 1
+            for key, value in record.items():
+                if key not in ('name', 'parent', 'pid', 'start') and isinstance(value, (int, float)):
+                    name_summary[key] = name_summary.get(key, 0) + value
+        return summary
+
+    def to_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.records, f)
+
+    def to_csv(self, path):
+        fieldnames = []
+        for record in self.records:
+            fieldnames.extend(key for key in record.keys() if key not in fieldnames)
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(self.records)
+
+
+registry = MetricsRegistry()
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def add(self, **counters):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    def __init__(self, name, counters):
+        self.record = dict(name=name, **counters)
+        self._child_peak = 0
+
+    def add(self, **counters):
+        # counters known only inside the span (m, leaves, bytes...)
+        self.record.update(counters)
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        self.record['parent'] = stack[-1].record['name'] if stack else None
+        self.record['pid'] = os.getpid()
+        stack.append(self)
+        # the traced memory and its peak are of the whole process - a span of another thread (the cluster workers of
+        # pce_runner) would reset the peak of the spans of the main thread, so only the main thread records memory
+        self._memory = tracemalloc.is_tracing() and threading.current_thread() is threading.main_thread()
+        if self._memory:
+            self._memory_start, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+        self.record['start'] = time.time()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.record['seconds'] = time.perf_counter() - self._start
+        _local.stack.pop()
+        if self._memory and tracemalloc.is_tracing():
+            memory_end, peak = tracemalloc.get_traced_memory()
+            # the peak was reset by every inner span - so the peak of the span is the max over them too
+            peak = max(peak, self._child_peak)
+            self.record['memory_delta_bytes'] = memory_end - self._memory_start
+            self.record['peak_memory_bytes'] = peak - self._memory_start
+            if _local.stack:
+                parent = _local.stack[-1]
+                parent._child_peak = max(parent._child_peak, peak)
+        registry.add(self.record)
+        return False
+
+
+def span(name, **counters):
+    '''
+    a named span of a stage - use as "with span('reconstruction', m=m) as s: ... s.add(leaves=leaves)"
+    :param name: the name of the stage
+    :param counters: numbers to record with the span
+    :return: the span context
+    '''
+    if not _modes:
+        return _NULL_SPAN
+    return _Span(name, counters)
+
+
+def profiled(f):
+    # a decorator - a span of the whole function, and a cProfile dump of it if 'cprofile' is on
+    @wraps(f)
+    def wrap(*args, **kw):
+        global _cprofile_pid
+        if not _modes:
+            return f(*args, **kw)
+        with span(f.__name__):
+            if CPROFILE_MODE not in _modes or _cprofile_pid == os.getpid():
+                return f(*args, **kw)
+            _cprofile_pid = os.getpid()
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(f, *args, **kw)
+            finally:
+                _cprofile_pid = None
+                profile_dir = os.environ.get(PROFILE_DIR_ENV_VAR, 'profiles')
+                os.makedirs(profile_dir, exist_ok=True)
+                profile.dump_stats(os.path.join(profile_dir, f'{f.__name__}_{os.getpid()}_{time.time_ns()}.prof'))
+
+    return wrap
+
+
+configure()
@@ -0,0 +1,131 @@
+import math
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+from utils import get_generator
+
+RECONSTRUCTION_BLOCK_SIZE = 4096
+# the entries of phi generated at once in a reconstruction - so its memory does not grow with m or with the leaves
+RECONSTRUCTION_BLOCK_ENTRIES = 2 ** 20
+
+_MIX_MULTIPLIER_1 = np.uint64(0xbf58476d1ce4e5b9)
+_MIX_MULTIPLIER_2 = np.uint64(0x94d049bb133111eb)
+
+
+def _mix64(x):
+    # splitmix64 finalizer - a cheap vectorized hash of uint64 arrays
+    x = (x ^ (x >> np.uint64(30))) * _MIX_MULTIPLIER_1
+    x = (x ^ (x >> np.uint64(27))) * _MIX_MULTIPLIER_2
+    return x ^ (x >> np.uint64(31))
+
+
+def _as_indices(key, size):
+    if isinstance(key, slice):
+        return np.arange(*key.indices(size))
+    return np.asarray(key)
+
+
+class Projection(ABC):
+    '''
+    phi - the (m, leaves) matrix of +-1/sqrt(m) the server asks the users about.
+    indexed like a numpy array - phi[j, :] is the row sent to a user, phi[rows, leaf_ids] are the entries of many users.
+    '''
+    def __init__(self, m, leaves_num):
+        self.m = m
+        self.leaves_num = leaves_num
+        self.shape = (m, leaves_num)
+        self.scale = 1 / math.sqrt(m)
+
+    @abstractmethod
+    def _signs(self, rows, cols):
+        '''
+        :param rows: row indices, broadcastable with cols
+        :param cols: column indices
+        :return: the +-1 signs of phi in these entries
+        '''
+
+    @property
+    @abstractmethod
+    def nbytes(self):
+        # the bytes phi keeps in memory
+        pass
+
+    def __getitem__(self, key):
+        rows, cols = key
+        rows_indices = _as_indices(rows, self.m)
+        cols_indices = _as_indices(cols, self.leaves_num)
+        if isinstance(rows, slice) or isinstance(cols, slice):
+            signs = self._signs(np.atleast_1d(rows_indices)[:, None], np.atleast_1d(cols_indices)[None, :])
+            signs = signs.reshape(rows_indices.shape + cols_indices.shape)
+        else:
+            signs = self._signs(rows_indices, cols_indices)
+        return signs * self.scale
+
+    def reconstruct(self, z, cols=None, block_entries=RECONSTRUCTION_BLOCK_ENTRIES, rows=None):
+        '''
+        phi[:, cols].T @ z, streaming over tiles of phi (blocks of rows, and of columns when there are many leaves),
+        so only block_entries entries of phi are in memory at once
+        :param z: the accumulator of the reports, per row - or an (m, runs) matrix of many runs, reconstructed at once
+        :param cols: the leaf ids to reconstruct, all of them if None
+        :param block_entries: number of entries of phi in every tile
+        :param rows: the rows z has the values of (a sparse z - the other rows are zeros), all the rows if None
+        :return: the count estimation of the leaves - (leaves,) or (leaves, runs)
+        '''
+        cols = np.arange(self.leaves_num) if cols is None else np.asarray(cols)
+        rows = np.arange(self.m) if rows is None else np.asarray(rows)
+        counts = np.zeros((len(cols),) + np.shape(z)[1:])
+        cols_per_block = max(1, min(len(cols), block_entries))
+        rows_per_block = max(1, block_entries // cols_per_block)
+        for cols_start in range(0, len(cols), cols_per_block):
+            block_cols = cols[cols_start:cols_start + cols_per_block]
+            for start in range(0, len(rows), rows_per_block):
+                block_rows = rows[start:start + rows_per_block]
+                counts[cols_start:cols_start + len(block_cols)] += \
+                    self._signs(block_rows[:, None], block_cols[None, :]).T @ z[start:start + rows_per_block]
+        return counts * self.scale
+
+
+class DenseProjection(Projection):
+    '''
+    phi materialized - but as int8 signs, 8 times smaller than the float matrix.
+    '''
+    def __init__(self, m, leaves_num, rng=None):
+        super().__init__(m, leaves_num)
+        rng = get_generator(rng)
+        # filled by blocks of rows, so the only full size array is the int8 one - the draws are the same as of a
+        # single rng.random((m, leaves_num))
+        self.signs = np.empty((m, leaves_num), dtype=np.int8)
+        rows_per_block = max(1, RECONSTRUCTION_BLOCK_ENTRIES // max(leaves_num, 1))
+        for start in range(0, m, rows_per_block):
+            block = self.signs[start:start + rows_per_block]
+            np.less(rng.random(block.shape), 0.5, out=block, casting='unsafe')
+            block *= -2
+            block += 1
+
+    def _signs(self, rows, cols):
+        return self.signs[rows, cols]
+
+    @property
+    def nbytes(self):
+        return self.signs.nbytes
+
+
+class SeededProjection(Projection):
+    '''
+    phi defined by a seed only - every entry is a hash of (seed, j, leaf id), so it is generated on demand
+    and a user can rebuild its row from (seed, j) alone: SeededProjection(seed, m, leaves_num)[j, :]
+    '''
+    def __init__(self, seed, m, leaves_num):
+        super().__init__(m, leaves_num)
+        self.seed = int(seed)
+        self._seed_key = _mix64(np.array([self.seed], dtype=np.uint64))[0]
+
+    def _signs(self, rows, cols):
+        keys = np.asarray(rows, dtype=np.uint64) * np.uint64(self.leaves_num) + np.asarray(cols, dtype=np.uint64)
+        hashes = _mix64(keys ^ self._seed_key)
+        return (hashes >> np.uint64(63)).astype(np.int8) * np.int8(2) - np.int8(1)
+
+    @property
+    def nbytes(self):
+        return 0
@@ -0,0 +1,253 @@
+import asyncio
+import json
+import time
+
+import numpy as np
+
+from locations_taxonomy import LocationsTaxonomy
+from personalized_count_estimator import TauPCEServer, basic_clusteting
+from projection import SeededProjection
+from simulation import simulate_static_situation
+from user import UsersPopulation
+
+MAX_PENDING_REPORTS = 10000
+REPORTS_BATCH_SIZE = 1024
+
+
+class AsyncReportCollector:
+    '''
+    the front end of the server - hands out the assignments (tau, row j, and the row of phi or its seed) to the users,
+    and takes their z_i reports concurrently. the reports wait in a bounded queue (so the senders wait when the
+    server falls behind) and are added to the servers of their taus in batches.
+    '''
+    def __init__(self, servers, max_pending=MAX_PENDING_REPORTS, batch_size=REPORTS_BATCH_SIZE):
+        '''
+        :param servers: a dictionary - for each tau index - its TauPCEServer
+        :param max_pending: number of reports that can wait to be added before the senders are slowed down
+        :param batch_size: the most reports added to the servers at once
+        '''
+        self.servers = servers
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self._queue = None
+        self._consumer = None
+        # the reports lost to an error while being added - with the last error, so the consumer itself never dies
+        self.dropped_reports = 0
+        self.last_error = None
+
+    async def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_pending)
+        self._consumer = asyncio.create_task(self._consume())
+
+    async def stop(self):
+        # waits for all the pending reports to be added
+        await self._queue.join()
+        self._consumer.cancel()
+        try:
+            await self._consumer
+        except asyncio.CancelledError:
+            pass
+
+    async def request_assignment(self, tau_index):
+        '''
+        :param tau_index: the tau the user is ok with showing the server
+        :return: the row j the user is asked about, and the row itself - or only the seed of phi, if it is implicit
+        '''
+        server = self._get_server(tau_index)
+        j = int(server.assign_rows())
+        assignment = {'tau_index': tau_index, 'j': j, 'm': server.m, 'leaves_num': server.phi.leaves_num}
+        if isinstance(server.phi, SeededProjection):
+            assignment['seed'] = server.phi.seed
+        else:
+            assignment['row'] = server.get_row(j).tolist()
+        return assignment
+
+    async def submit_report(self, tau_index, j, zi):
+        '''
+        a ValueError is raised for a report of a tau with no server, of a row out of phi or with a non-finite z_i -
+        before it is queued, so a bad report never reaches the consumer
+        '''
+        server = self._get_server(tau_index)
+        if isinstance(j, bool) or not isinstance(j, (int, np.integer)) or not 0 <= j < server.m:
+            raise ValueError(f'row {j!r} is out of the {server.m} rows of tau {tau_index}')
+        try:
+            zi = float(zi)
+        except (TypeError, ValueError):
+            raise ValueError(f'report {zi!r} is not a number')
+        if not np.isfinite(zi):
+            raise ValueError(f'report {zi!r} is not finite')
+        # waits when max_pending reports are already waiting - the backpressure on the senders
+        await self._queue.put((tau_index, int(j), zi))
+
+    def _get_server(self, tau_index):
+        try:
+            return self.servers[tau_index]
+        except (KeyError, TypeError):
+            raise ValueError(f'no server for tau {tau_index!r}')
+
+    async def _consume(self):
+        while True:
+            reports = [await self._queue.get()]
+            while len(reports) < self.batch_size and not self._queue.empty():
+                reports.append(self._queue.get_nowait())
+            try:
+                taus, rows, zis = (np.array(column) for column in zip(*reports))
+                for tau_index in np.unique(taus):
+                    tau_reports = taus == tau_index
+                    self.servers[int(tau_index)].add_reports(rows[tau_reports], zis[tau_reports])
+            except Exception as e:
+                self.dropped_reports += len(reports)
+                self.last_error = e
+            finally:
+                # even for a failed batch, so stop() does not wait for it forever
+                for _ in reports:
+                    self._queue.task_done()
+
+    async def _handle_message(self, line):
+        try:
+            message = json.loads(line)
+            if message['op'] == 'assign':
+                return await self.request_assignment(message['tau_index'])
+            if message['op'] == 'report':
+                await self.submit_report(message['tau_index'], message['j'], message['zi'])
+                return {'ok': True}
+            return {'error': f"unknown op {message['op']}"}
+        except json.JSONDecodeError as e:
+            return {'error': f'bad json: {e}'}
+        except KeyError as e:
+            return {'error': f'missing field {e}'}
+        except (TypeError, ValueError) as e:
+            return {'error': str(e)}
+
+    async def _handle_connection(self, reader, writer):
+        # one json message per line: {"op": "assign", "tau_index": ...} or {"op": "report", "tau_index", "j", "zi"}
+        # a bad message gets an error response, the connection stays open
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                response = await self._handle_message(line)
+                writer.write((json.dumps(response) + '\n').encode())
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=0):
+        '''
+        :return: an asyncio server of the collector over tcp (port 0 - any free port)
+        '''
+        return await asyncio.start_server(self._handle_connection, host, port)
+
+
+class TCPReportClient:
+    '''
+    a connection of a user to a collector served over tcp - with the same methods as the collector itself
+    '''
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+
+    @staticmethod
+    async def connect(host, port):
+        reader, writer = await asyncio.open_connection(host, port)
+        return TCPReportClient(reader, writer)
+
+    async def _request(self, message):
+        self._writer.write((json.dumps(message) + '\n').encode())
+        await self._writer.drain()
+        response = json.loads(await self._reader.readline())
+        # as the collector itself - a rejected message is a ValueError
+        if 'error' in response:
+            raise ValueError(response['error'])
+        return response
+
+    async def request_assignment(self, tau_index):
+        return await self._request({'op': 'assign', 'tau_index': tau_index})
+
+    async def submit_report(self, tau_index, j, zi):
+        await self._request({'op': 'report', 'tau_index': tau_index, 'j': j, 'zi': zi})
+
+    async def close(self):
+        self._writer.close()
+        await self._writer.wait_closed()
+
+
+def _assigned_row(assignment):
+    # the row of phi of the assignment - rebuilt from the seed if phi is implicit
+    if 'seed' in assignment:
+        return SeededProjection(assignment['seed'], assignment['m'], assignment['leaves_num'])[assignment['j'], :]
+    return np.array(assignment['row'])
+
+
+async def run_load_generator(collectors, users: UsersPopulation, taxonomy: LocationsTaxonomy, concurrency=100):
+    '''
+    every user of the population asks for an assignment and sends back its report from SystemUser.local_randomizer,
+    with concurrency users at a time
+    :param collectors: the collector (or a list of connections to it, used round robin by the concurrent users)
+    :param users: the users to send the reports of
+    :param taxonomy: the taxonomy of the users
+    :param concurrency: number of users sending at the same time
+    :return: the throughput and the latencies of the reports
+    '''
+    if not isinstance(collectors, list):
+        collectors = [collectors]
+    node_id_to_leaf_id = {}
+    latencies = np.zeros(len(users))
+    next_user = iter(range(len(users)))
+
+    async def client(collector):
+        for i in next_user:
+            user = users.get_user(i, taxonomy)
+            if user.tau.index not in node_id_to_leaf_id:
+                node_id_to_leaf_id[user.tau.index] = {int(index): leaf_id for leaf_id, index in
+                                                      enumerate(taxonomy.get_leaves_node_indices(user.tau))}
+            ts = time.perf_counter()
+            assignment = await collector.request_assignment(user.tau.index)
+            zi = user.local_randomizer(_assigned_row(assignment), node_id_to_leaf_id[user.tau.index],
+                                       assignment['m'])
+            await collector.submit_report(user.tau.index, assignment['j'], float(np.asarray(zi).item()))
+            latencies[i] = time.perf_counter() - ts
+
+    ts = time.perf_counter()
+    await asyncio.gather(*[client(collectors[i % len(collectors)]) for i in range(concurrency)])
+    seconds = time.perf_counter() - ts
+    return {'users': len(users), 'seconds': seconds, 'reports_per_second': len(users) / seconds,
+            'latency_p50': float(np.percentile(latencies, 50)), 'latency_p95': float(np.percentile(latencies, 95)),
+            'latency_p99': float(np.percentile(latencies, 99))}
+
+
+async def local_benchmark(num_users=10000, height=1, beta=0.1, epsilons=(1,), concurrency=100, implicit_phi=False,
+                          tcp=False):
+    '''
+    the whole client-server exchange on one machine - a simulated population sends its reports to a collector
+    :param tcp: send the reports over a local tcp connection per concurrent user, instead of in process
+    :return: the load generator stats
+    '''
+    inputs_dictionary, users = simulate_static_situation(epsilons=list(epsilons), num_users=num_users, height=height,
+                                                         beta=beta)
+    taxonomy = inputs_dictionary['taxonomy']
+    servers = {tau_index: TauPCEServer.for_expected_users(beta, len(tau_users), tau_index, taxonomy,
+                                                          implicit_phi=implicit_phi)
+               for tau_index, tau_users in basic_clusteting(users).items()}
+    collector = AsyncReportCollector(servers)
+    await collector.start()
+    if tcp:
+        tcp_server = await collector.serve()
+        host, port = tcp_server.sockets[0].getsockname()[:2]
+        clients = [await TCPReportClient.connect(host, port) for _ in range(concurrency)]
+        stats = await run_load_generator(clients, users, taxonomy, concurrency=concurrency)
+        for client in clients:
+            await client.close()
+        tcp_server.close()
+        await tcp_server.wait_closed()
+    else:
+        stats = await run_load_generator(collector, users, taxonomy, concurrency=concurrency)
+    await collector.stop()
+    stats['reports_received'] = sum(server.reports_num for server in servers.values())
+    return stats
+
+
+if __name__ == '__main__':
+    print(asyncio.run(local_benchmark()))
+    print(asyncio.run(local_benchmark(implicit_phi=True, tcp=True)))
@@ -0,0 +1,193 @@
+import glob
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+SCHEMA_FILE = 'schema.json'
+SHARD_SIZE = 16
+# scalars and arrays are kept apart in the shards - the same name can be a scalar in a row and an array in another
+SCALAR_PREFIX = 'scalar__'
+ARRAY_PREFIX = 'array__'
+OFFSETS_PREFIX = 'offsets__'
+
+
+def _split_row(row):
+    '''
+    :param row: a results dictionary
+    :return: its scalars, and its arrays (lists of numbers too) - the other values (None, the taxonomy...) are dropped
+    '''
+    scalars, arrays = {}, {}
+    for key, value in row.items():
+        if value is None:
+            continue
+        if np.isscalar(value):
+            scalars[key] = value.item() if isinstance(value, np.generic) else value
+        elif isinstance(value, (np.ndarray, list, tuple)):
+            array = np.asarray(value)
+            if array.dtype.kind in 'biuf':
+                arrays[key] = array.ravel()
+    return scalars, arrays
+
+
+def _kind(dtype):
+    # the kinds a column may keep along the shards - an int column can still get floats (nan for a missing value)
+    return {'b': 'number', 'i': 'number', 'u': 'number', 'f': 'number', 'U': 'string', 'S': 'string'}[dtype.kind]
+
+
+class ResultsStore:
+    '''
+    the results of an experiment, appended row by row - every SHARD_SIZE rows are written as a columnar .npz shard:
+    an array per scalar column, and per array column (the counts of every leaf...) all the arrays of the shard
+    concatenated, with their offsets. only the rows of the current shard are kept in memory, and the shards are
+    written atomically, so a stopped sweep keeps all the shards written till then.
+    schema.json keeps the columns and their kinds, so a later row of another kind for a column is an error.
+    '''
+    def __init__(self, directory, shard_size=SHARD_SIZE):
+        '''
+        :param directory: the directory of the store, created if missing
+        :param shard_size: number of rows in every shard
+        '''
+        self.directory = directory
+        self.shard_size = shard_size
+        os.makedirs(directory, exist_ok=True)
+        self.schema = {'scalars': {}, 'arrays': {}}
+        if os.path.exists(os.path.join(directory, SCHEMA_FILE)):
+            with open(os.path.join(directory, SCHEMA_FILE), 'r') as f:
+                self.schema = json.load(f)
+        self._pending = []
+        self._shards_num = len(self.shard_paths())
+
+    def shard_paths(self):
+        return sorted(glob.glob(os.path.join(self.directory, 'shard_' + '[0-9]' * 6 + '.npz')))
+
+    def append(self, row):
+        '''
+        :param row: a results dictionary of scalars and arrays
+        '''
+        self._pending.append(_split_row(row))
+        if len(self._pending) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        # writes the pending rows as a shard
+        if not self._pending:
+            return
+        columns = {}
+        self._add_columns(columns, 'scalars', [scalars for scalars, _ in self._pending])
+        self._add_columns(columns, 'arrays', [arrays for _, arrays in self._pending])
+        path = os.path.join(self.directory, f'shard_{self._shards_num:06d}.npz')
+        # hidden, and not ending with .npz - a shard killed while being written is never taken for a shard
+        temp_path = os.path.join(self.directory, f'.shard_{self._shards_num:06d}.npz.tmp')
+        with open(temp_path, 'wb') as f:
+            np.savez(f, **columns)
+        with open(os.path.join(self.directory, SCHEMA_FILE + '.tmp'), 'w') as f:
+            json.dump(self.schema, f, indent=2)
+        os.replace(temp_path, path)
+        os.replace(os.path.join(self.directory, SCHEMA_FILE + '.tmp'), os.path.join(self.directory, SCHEMA_FILE))
+        self._shards_num += 1
+        self._pending = []
+
+    def _add_columns(self, columns, section, rows):
+        names = []
+        for row in rows:
+            names.extend(name for name in row.keys() if name not in names)
+        for name in names:
+            if section == 'scalars':
+                values = [row.get(name) for row in rows]
+                present = [value for value in values if value is not None]
+                dtype = np.asarray(present).dtype
+                missing = '' if dtype.kind in 'US' else np.nan
+                column = np.asarray([missing if value is None else value for value in values])
+            else:
+                arrays = [row.get(name, np.array([])) for row in rows]
+                column = np.concatenate(arrays) if arrays else np.array([])
+                columns[OFFSETS_PREFIX + name] = np.cumsum([0] + [len(array) for array in arrays])
+            kind = _kind(column.dtype)
+            if self.schema[section].setdefault(name, kind) != kind:
+                raise ValueError(f'column {name} is {self.schema[section][name]}, got {kind}')
+            columns[(SCALAR_PREFIX if section == 'scalars' else ARRAY_PREFIX) + name] = column
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def __len__(self):
+        return sum(len(self._shard_index(shard)) for shard in self._iter_shards()) + len(self._pending)
+
+    def _iter_shards(self):
+        for path in self.shard_paths():
+            with np.load(path) as shard:
+                yield shard
+
+    def _shard_index(self, shard):
+        # the rows of a shard - by the offsets of an array column, or by a scalar column
+        for name in shard.files:
+            if name.startswith(OFFSETS_PREFIX):
+                return np.arange(len(shard[name]) - 1)
+        return np.arange(len(shard[shard.files[0]]))
+
+    def load_scalars(self, columns=None):
+        '''
+        only the scalar columns are read - the arrays are left on the disk
+        :param columns: the columns to load, all the scalar columns if None
+        :return: a DataFrame of a row per results row
+        '''
+        columns = list(self.schema['scalars'].keys()) if columns is None else columns
+        frames = []
+        for shard in self._iter_shards():
+            rows_num = len(self._shard_index(shard))
+            frames.append(pd.DataFrame({name: shard[SCALAR_PREFIX + name] if SCALAR_PREFIX + name in shard.files
+                                        else np.full(rows_num, np.nan) for name in columns}))
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns)
+
+    def iter_arrays(self, name, columns=()):
+        '''
+        the arrays of a column row by row, shard by shard - so only a shard is in memory at once
+        :param name: the array column
+        :param columns: scalar columns to yield with every array
+        :return: an iterator of (the scalars of the row, its array)
+        '''
+        for shard in self._iter_shards():
+            if ARRAY_PREFIX + name not in shard.files:
+                continue
+            values, offsets = shard[ARRAY_PREFIX + name], shard[OFFSETS_PREFIX + name]
+            scalars = {column: shard[SCALAR_PREFIX + column] for column in columns}
+            for i in range(len(offsets) - 1):
+                yield {column: scalars[column][i].item() for column in columns}, values[offsets[i]:offsets[i + 1]]
+
+    def to_parquet(self, path):
+        # the scalar columns as a parquet file (needs pyarrow or fastparquet)
+        self.load_scalars().to_parquet(path)
+
+
+def summarize(df, by, metrics, aggregations=('mean', 'std'), sort_by=None):
+    '''
+    the groupby summary of the results - as the ones the experiments used to write
+    :param df: the scalars of a store (see ResultsStore.load_scalars)
+    :param by: the columns to group by
+    :param metrics: the metrics to aggregate
+    :param aggregations: the aggregations of every metric
+    :param sort_by: a (metric, aggregation) to sort by
+    :return: the summary DataFrame
+    '''
+    summary = df.groupby(by=list(by)).agg({metric: list(aggregations) for metric in metrics})
+    if sort_by is not None:
+        summary = summary.sort_values(by=sort_by)
+    return summary
+
+
+def export_excel(df, path):
+    '''
+    the optional last step - a summary as an excel file, for reading it by eye
+    :param path: the excel file, its directory is created if missing
+    '''
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    df.to_excel(path)
@@ -1,55 +1,72 @@
-import copy
-
 import numpy as np
-from typing import Dict, List
+from typing import Dict
 
-from locations_taxonomy import LocationsTaxonomy, TelAviv_json_dir
-from user import SystemUser
+from locations_taxonomy import TelAviv_json_dir, load_taxonomy
+from user import UsersPopulation
 from utils import REAL_COUNTS_LIST, ESTIMATED_COUNTS_LIST, CHANGES
 
 
-def simulate_static_situation(taxonomy=LocationsTaxonomy(TelAviv_json_dir),
-                              epsilons=[1], num_users=100, beta=0.1, height=1, **args):
+def simulate_static_situation(taxonomy=None,
+                              epsilons=[1], num_users=100, beta=0.1, height=1, location_weights=None,
+                              random_seed=None, **args):
     '''
     build a static situation of people parking in the city - using the
-    changing the seed affects it as the get_random_static_user is affected by it.
+    changing the seed affects it as the get_random_static_population is affected by it.
 
-    :param taxonomy:  the taxonomy of the system
+    :param taxonomy:  the taxonomy of the system, Tel Aviv (loaded once, on the first use) if None
     :param epsilons: the epsilons each user is randomly choosing from
     :param num_users: number of users the static situation should conjtain
     :param beta: the accuracy param
     :param height: the height each user is Ok with the server seeing
+    :param location_weights: a weight per leaf id for the parking demand of the area, uniform if None
+    :param random_seed: the seed of the whole population, drawn from the global seed if None
     :param args: just to being able to call the function using a dictionary of params
-    :return: inputs of the function - for documentation of experiments, users list - for usage
+    :return: inputs of the function - for documentation of experiments, users population - for usage
     '''
+    if taxonomy is None:
+        taxonomy = load_taxonomy(TelAviv_json_dir)
     inputs_dictionary = {
         'epsilons': epsilons,
         'num_users': num_users,
         'height': height,
         'beta': beta,
-        'taxonomy_hash': hash(taxonomy), #irrelevant when changin the seed
-        'taxonomy': taxonomy
+        'taxonomy_hash': taxonomy.content_hash,
+        'taxonomy': taxonomy,
+        'location_weights': location_weights
 
     }
-    users = [SystemUser.get_random_static_user(taxonomy, epsilons, height=height) for i in range(num_users)]
+    rng = None if random_seed is None else np.random.default_rng(random_seed)
+    users = UsersPopulation.get_random_static_population(taxonomy, epsilons, num_users, height,
+                                                         location_weights=location_weights, rng=rng)
     return inputs_dictionary, users
 
 
-def change_static_simulation(users: List[SystemUser], deletion_probability: float, addition_probability: float, inputs_dict):
+def change_static_simulation(users: UsersPopulation, deletion_probability: float, addition_probability: float, inputs_dict):
     '''
     change a static simulation so it will contain the right users after addition and deletion to dynamic simulaton
-    :param users:
+    :param users: the population of the static simulation
     :param deletion_probability: the probability a user will be deleted
     :param addition_probability: portion of users to add to the situation
     :param inputs_dict: the doictionary to make new static situation with the *new* users only
     :return: the inputs dictionary for documentation, and the users that were added
     '''
-    inputs_dict = copy.deepcopy(inputs_dict)
+    inputs_dictionary, stayed, more_users = simulate_static_changes(users, deletion_probability, addition_probability,
+                                                                    inputs_dict)
+    new_users = users[stayed].concatenate(more_users)
+    return inputs_dictionary, new_users
+
+
+def simulate_static_changes(users: UsersPopulation, deletion_probability: float, addition_probability: float,
+                            inputs_dict):
+    '''
+    the changes of change_static_simulation, without applying them - for updating the estimations incrementally
+    :return: the inputs dictionary for documentation, a mask of the users that stayed, and the users that were added
+    '''
+    inputs_dict = dict(inputs_dict)  # the taxonomy is shared, not copied
     inputs_dict['num_users'] = int(addition_probability * len(users))
-    stayed_users = np.random.choice(users, int(len(users) * (1 - deletion_probability)))
+    stayed = users.random_stayed_mask(deletion_probability)
     inputs_dictionary, more_users = simulate_static_situation(**inputs_dict)
-    new_users = list(stayed_users) + list(more_users)
-    return inputs_dictionary, new_users
+    return inputs_dictionary, stayed, more_users
 
 
 def make_dynamic_effects_dictionary(original_results: Dict, dynamically_changed_results: Dict):
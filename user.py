@@ -3,6 +3,8 @@ import random
 
 import numpy as np
 
+from utils import get_generator
+
 SMALL_NUMBER = 0.0001
 
 
@@ -48,7 +50,7 @@ class SystemUser:
 
 
 def _calc_c_epsilon(epsilon):
-    exp_eps = math.exp(epsilon)
+    exp_eps = np.exp(epsilon)
     c_eps = (exp_eps + 1) / (exp_eps - 1)
     return c_eps, exp_eps
 
@@ -62,3 +64,127 @@ def _get_zi(epsilon, m, x_li):
     return sign * c_eps * m * x_li
 
 
+def batch_local_reports(phi: np.array, rows: np.array, leaf_ids: np.array, epsilons: np.array, m, rng=None):
+    '''
+    the local randomizer of many users at once - statistically the same as calling local_randomizer for every one of them
+    :param phi: the (m, leaves) matrix of the server
+    :param rows: for each user - the row j of phi it was asked about (a row of them per run, for many runs at once)
+    :param leaf_ids: for each user - the id of its location among the leaves of tau
+    :param epsilons: for each user - its privacy epsilon
+    :param m: size of the space
+    :param rng: numpy Generator to draw the signs with, drawn from the global seed if None
+    :return: z_i - the answer of every user
+    '''
+    rng = get_generator(rng)
+    c_eps, exp_eps = _calc_c_epsilon(np.asarray(epsilons, dtype=float))
+    prob_plus = exp_eps / (exp_eps + 1)
+    signs = np.where(rng.random(np.shape(rows)) < prob_plus, 1.0, -1.0)
+    return signs * c_eps * m * phi[rows, leaf_ids]
+
+
+class UsersPopulation:
+    '''
+    a columnar store of many users of the system - instead of a list of SystemUser.
+    every user is a row in the numpy columns: its epsilon, the index of its tau node and the index of its location leaf.
+    '''
+    def __init__(self, epsilons, tau_indices, location_indices):
+        self.epsilons = np.asarray(epsilons, dtype=np.float64)
+        self.tau_indices = np.asarray(tau_indices, dtype=np.int64)
+        self.location_indices = np.asarray(location_indices, dtype=np.int64)
+        assert len(self.epsilons) == len(self.tau_indices) == len(self.location_indices)
+
+    def __len__(self):
+        return len(self.epsilons)
+
+    def __getitem__(self, item):
+        '''
+        :param item: a slice (a zero-copy view), or an indices/mask array (a copy)
+        :return: a UsersPopulation of the chosen users
+        '''
+        return UsersPopulation(self.epsilons[item], self.tau_indices[item], self.location_indices[item])
+
+    @property
+    def nbytes(self):
+        return self.epsilons.nbytes + self.tau_indices.nbytes + self.location_indices.nbytes
+
+    @staticmethod
+    def get_random_static_population(taxonomy, epsilons, num_users, height, location_weights=None, rng=None):
+        '''
+        the users of a whole static situation at once - as get_random_static_user for every user, with a few
+        vectorized draws.
+        :param taxonomy: the taxonomy of the system the users participate in
+        :param epsilons: the privacy epsilons each user is randomly choosing from
+        :param num_users: number of users
+        :param height: the height that the users are ok with showing the server
+        :param location_weights: a weight per leaf id (as the parking demand of every area) - the locations are drawn
+        by it, and the tau of every user is the node of the height above its location. uniform taus and locations
+        under them if None
+        :param rng: numpy Generator, drawn from the global seed if None
+        :return: the population
+        '''
+        rng = get_generator(rng)
+        users_epsilons = rng.choice(np.asarray(epsilons, dtype=np.float64), size=num_users)
+        if location_weights is None:
+            tau_indices = taxonomy.sample_random_nodes(height, num_users, rng=rng)
+            location_indices = taxonomy.sample_random_leaves(tau_indices, rng=rng)
+        else:
+            leaf_ids, leaves_taus = taxonomy.get_leaves_under_height(height)
+            weights = np.asarray(location_weights, dtype=np.float64)[leaf_ids]
+            chosen = rng.choice(len(leaf_ids), size=num_users, p=weights / weights.sum())
+            tau_indices = leaves_taus[chosen]
+            location_indices = taxonomy.leaves_node_indices[leaf_ids[chosen]]
+        return UsersPopulation(users_epsilons, tau_indices, location_indices)
+
+    def get_user(self, i, taxonomy):
+        '''
+        :param i: the row of the user
+        :param taxonomy: the taxonomy the indices of the population refer to
+        :return: the i-th user as a SystemUser - for the client side usage
+        '''
+        location_index = int(self.location_indices[i])
+        return SystemUser(float(self.epsilons[i]), taxonomy.get_node(int(self.tau_indices[i])),
+                          taxonomy.get_node(location_index), location_index)
+
+    def group_by_tau(self):
+        '''
+        users are clustered by their tau, with one argsort - the population is reordered once and every cluster
+        is a zero-copy view of the reordered columns.
+        :return: a dictionary - for each tau index - the population under it
+        '''
+        order, taus, starts, ends = self._tau_groups()
+        ordered = self[order]
+        return {int(tau): ordered[start:end] for tau, start, end in zip(taus, starts, ends)}
+
+    def group_indices_by_tau(self):
+        '''
+        :return: a dictionary - for each tau index - the rows of its users in the population
+        '''
+        order, taus, starts, ends = self._tau_groups()
+        return {int(tau): order[start:end] for tau, start, end in zip(taus, starts, ends)}
+
+    def _tau_groups(self):
+        order = np.argsort(self.tau_indices, kind='stable')
+        taus, starts = np.unique(self.tau_indices[order], return_index=True)
+        ends = np.append(starts[1:], len(self)).astype(starts.dtype)
+        return order, taus, starts, ends
+
+    def random_stayed_mask(self, deletion_probability, rng=None):
+        '''
+        :param deletion_probability: the portion of the users to delete
+        :param rng: numpy Generator, drawn from the global seed if None
+        :return: a mask of the users that stayed
+        '''
+        rng = get_generator(rng)
+        stayed_num = int(len(self) * (1 - deletion_probability))
+        stayed = np.zeros(len(self), dtype=bool)
+        stayed[rng.choice(len(self), stayed_num, replace=False)] = True
+        return stayed
+
+    def concatenate(self, other):
+        '''
+        :param other: the population to add
+        :return: a new population with the users of both
+        '''
+        return UsersPopulation(np.concatenate([self.epsilons, other.epsilons]),
+                               np.concatenate([self.tau_indices, other.tau_indices]),
+                               np.concatenate([self.location_indices, other.location_indices]))
@@ -1,6 +1,4 @@
 import random
-from functools import wraps
-from time import time
 
 import numpy as np
 
@@ -10,23 +8,18 @@ ESTIMATED_COUNTS_LIST = 'estimated_counts_list'
 
 CHANGES = 'changes_'
 
-def timing(f):
-    # a decorator for function timinf
-    @wraps(f)
-    def wrap(*args, **kw):
-        ts = time()
-        result = f(*args, **kw)
-        te = time()
-        # print('func:%r args:[%r, %r] took: %2.4f sec' % \
-        #       (f.__name__, args, kw, te - ts))
-        print('func:%r took: %2.4f sec' % \
-              (f.__name__, te - ts))
-        return result
-
-    return wrap
+REAL_TREE_COUNTS = 'real_tree_counts'
 
+ESTIMATED_TREE_COUNTS = 'estimated_tree_counts'
 
 def set_random_seed(random_seed):
     # set a random seed for both random and numpy
     random.seed(random_seed)
-    np.random.seed(random_seed)
\ No newline at end of file
+    np.random.seed(random_seed)
+
+
+def get_generator(rng=None):
+    # a numpy Generator - seeded from the global numpy seed if not given, so set_random_seed still applies
+    if rng is None:
+        return np.random.default_rng(np.random.randint(2 ** 32, dtype=np.uint64))
+    return rng